@@ -3,13 +3,15 @@ from __future__ import unicode_literals, absolute_import
 
 """Flask app for Rophako."""
 
-from flask import (Flask, g, request, session, render_template, send_file,
-    abort, redirect)
+from flask import (Flask, Request, g, request, session, render_template,
+    send_file, abort, redirect, make_response)
 from flask_sslify import SSLify
 from flask_compress import Compress
 import jinja2
+import jinja2.ext
 import os.path
 import datetime
+import time
 import sys
 
 # Get the Flask app object ready right away so other modules can import it
@@ -19,6 +21,10 @@ app = Flask(__name__,
 )
 Compress(app)
 
+# Streamed pages (see `rophako.utils.stream_template()`) are sent as they're
+# rendered; compressing them would mean buffering them first.
+app.config["COMPRESS_STREAMS"] = False
+
 # We use a custom Jinja loader to support multiple template paths for custom
 # and default templates. The base list of template paths to check includes
 # your custom path (from config.SITE_ROOT), the "rophako/www" path for normal
@@ -35,6 +41,9 @@ from rophako.plugin import load_plugin
 from rophako.log import logger
 #import rophako.model.tracking as Tracking
 import rophako.utils
+import rophako.jsondb as JsonDB
+import rophako.jobs as Jobs
+import rophako.mail # Registers the e-mail job.
 
 # String escaping for the secret key (processes \ escapes properly), the
 # escape encoding name varies between Python 2 and 3.
@@ -45,8 +54,53 @@ app.DEBUG      = Config.site.debug == "true"
 app.secret_key = bytes(Config.security.secret_key.encode("utf-8")) \
                  .decode(string_escape)
 
-# Make templates easier to edit live.
-app.config["TEMPLATES_AUTO_RELOAD"] = True
+
+class TemplateFolderCache(jinja2.FileSystemBytecodeCache):
+    """Bytecode cache in a folder, which is created when the first template
+    is saved into it rather than when the app is loaded."""
+
+    def dump_bytecode(self, bucket):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory, mode=0o700)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+        super(TemplateFolderCache, self).dump_bytecode(bucket)
+
+
+# Make templates easier to edit live. In production mode, templates are only
+# read once, and compiled templates are cached across restarts.
+app.config["TEMPLATES_AUTO_RELOAD"] = Config.site.production != True
+if Config.site.production == True:
+    if Config.site.template_cache == "redis" and JsonDB.get_redis():
+        app.jinja_env.bytecode_cache = jinja2.MemcachedBytecodeCache(
+            JsonDB.get_redis(),
+            prefix=Config.db.redis_prefix + "jinja2/",
+        )
+    else:
+        cache_dir = Config.site.template_cache
+        if cache_dir == "redis":
+            cache_dir = os.path.join(Config.site.tempdir, "rophako-templates")
+        app.jinja_env.bytecode_cache = TemplateFolderCache(cache_dir)
+
+app.permanent_session_lifetime = datetime.timedelta(days=Config.security.session_lifetime)
+
+
+class RophakoRequest(Request):
+    """Request class that spools uploaded files straight into the temp folder
+    (see `rophako.utils.UploadSpool`), so that the photo albums can move them
+    into place instead of copying them."""
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        spool = rophako.utils.UploadSpool()
+        if not hasattr(self, "upload_spools"):
+            self.upload_spools = []
+        self.upload_spools.append(spool)
+        return spool
+
+app.request_class = RophakoRequest
 
 # Security?
 if Config.security.force_ssl == True:
@@ -64,12 +118,93 @@ template_paths = [
    "rophako/www",         # Default/fall-back
 ]
 template_paths.extend(BLUEPRINT_PATHS)
-app.jinja_loader = jinja2.ChoiceLoader([ jinja2.FileSystemLoader(x) for x in template_paths])
+
+# The file extensions of the templates (see TemplateIndexLoader and
+# scripts/precompile-templates.py).
+TEMPLATE_EXTENSIONS = ["html", "txt", "xml"]
+
+
+class TemplateIndexLoader(jinja2.BaseLoader):
+    """Jinja loader for production mode.
+
+    The ChoiceLoader checks each template path in turn, every time a template
+    is looked up. This loader walks all the paths once at startup and
+    remembers where each template lives (earlier paths take priority, same as
+    the ChoiceLoader). Only the files with TEMPLATE_EXTENSIONS outside of the
+    static folders (and the photo folder) are indexed.
+
+    New templates added after startup are still found, they just cost a
+    search on their first use, and templates deleted after startup fall back
+    to the next path. A site template added after startup to override a
+    default one isn't seen until the app is restarted."""
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.index = dict()
+        skip = os.path.abspath(Config.photo.root_private)
+        for root in reversed(paths):
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames[:] = [ d for d in dirnames if d != "static"
+                    and os.path.abspath(os.path.join(dirpath, d)) != skip ]
+                for filename in filenames:
+                    if not filename.rsplit(".", 1)[-1] in TEMPLATE_EXTENSIONS:
+                        continue
+                    abspath = os.path.join(dirpath, filename)
+                    name = os.path.relpath(abspath, root).replace(os.path.sep, "/")
+                    self.index[name] = abspath
+
+    def get_source(self, environment, template):
+        path = self.index.get(template)
+        if path is None or not os.path.isfile(path):
+            pieces = jinja2.loaders.split_template_path(template)
+            for root in self.paths:
+                candidate = os.path.join(root, *pieces)
+                if os.path.isfile(candidate):
+                    path = self.index[template] = candidate
+                    break
+            else:
+                self.index.pop(template, None)
+                raise jinja2.TemplateNotFound(template)
+
+        with open(path, "rb") as fh:
+            source = fh.read().decode("utf-8")
+
+        mtime = os.path.getmtime(path)
+        def uptodate():
+            try:
+                return os.path.getmtime(path) == mtime
+            except OSError:
+                return False
+
+        return source, path, uptodate
+
+    def list_templates(self):
+        return sorted(self.index.keys())
+
+
+if Config.site.production == True:
+    app.jinja_loader = TemplateIndexLoader(template_paths)
+else:
+    app.jinja_loader = jinja2.ChoiceLoader([ jinja2.FileSystemLoader(x) for x in template_paths])
+
+
+class TimeElapsedExtension(jinja2.ext.Extension):
+    """Support the `%time_elapsed%` placeholder in templates.
+
+    It's turned into a call to the `time_elapsed()` global when the template
+    is compiled, instead of being searched for in every page after it's
+    rendered."""
+
+    def preprocess(self, source, name, filename=None):
+        return source.replace("%time_elapsed%", "{{ time_elapsed() }}")
+
+app.jinja_env.add_extension(TimeElapsedExtension)
 
 app.jinja_env.trim_blocks = True
 app.jinja_env.lstrip_blocks = True
 app.jinja_env.globals["csrf_token"] = rophako.utils.generate_csrf_token
 app.jinja_env.globals["include_page"] = rophako.utils.include
+app.jinja_env.globals["time_elapsed"] = rophako.utils.time_elapsed
 app.jinja_env.globals["settings"] = lambda: Config
 app.jinja_env.globals["strftime"] = lambda x: datetime.datetime.utcnow().strftime(x)
 
@@ -78,13 +213,63 @@ import rophako.model.emoticons as Emoticons
 Emoticons.load_theme()
 
 
+@app.before_request
+def start_timer():
+    """Note the time the request started, for `time_elapsed()` and the
+    Server-Timing header."""
+    g.request_start = time.time()
+
+
+@app.before_request
+def start_jobs():
+    """Start this process's job thread with its first request, so that the
+    startup jobs get to clean up after the last run (see `rophako.jobs`).
+    With `jobs.worker`, that's the worker's job instead."""
+    if not Config.jobs.worker:
+        Jobs.start_local_worker()
+
+
+@app.before_request
+def page_cache_lookup():
+    """Serve anonymous visitors a cached copy of the page, if we have one.
+
+    This runs ahead of `before_request()` so that a cache hit skips all of the
+    session, DB and template work for the page."""
+    key = rophako.utils.page_cache_key()
+    if not key:
+        return
+    g.page_cache_key = key
+
+    cached = JsonDB.get_cache(key)
+    if not cached:
+        return
+
+    # Still fresh?
+    if JsonDB.get_tag_versions(cached["tags"].keys()) != cached["tags"]:
+        return
+
+    logger.debug("Page cache hit: {}".format(key))
+    g.page_cache_hit = True
+
+    # Does the browser already have the latest copy? (The view would've
+    # checked this itself, see `rophako.utils.not_modified()`.)
+    if cached.get("documents"):
+        unchanged = rophako.utils.not_modified(*cached["documents"])
+        if unchanged is not None:
+            return unchanged
+
+    html = rophako.utils.fill_page_cache_slots(cached["html"], g.request_start)
+    return make_response(html)
+
+
 @app.before_request
 def before_request():
     """Called before all requests. Initialize global template variables."""
 
-    # Session lifetime.
-    app.permanent_session_lifetime = datetime.timedelta(days=Config.security.session_lifetime)
-    session.permanent = True
+    # Session lifetime. Only set the flag when it's missing; setting it marks
+    # the session as modified, which means a new cookie on every response.
+    if not session.permanent:
+        session.permanent = True
 
     # Default template vars.
     g.info = rophako.utils.default_vars()
@@ -99,19 +284,23 @@ def before_request():
         if not token or str(token) != str(request.form.get("token")):
             abort(403)
 
-    # Refresh their login status from the DB.
+    # Refresh their login status from the DB, if their account has changed
+    # since we last looked.
     if session["login"]:
         import rophako.model.user as User
-        if not User.exists(uid=session["uid"]):
-            # Weird! Log them out.
-            from rophako.modules.account import logout
-            logout()
-            return
-
-        db = User.get_user(uid=session["uid"])
-        session["username"] = db["username"]
-        session["name"]     = db["name"]
-        session["role"]     = db["role"]
+        stamp = User.get_stamp(session["uid"])
+        if session.get("user_stamp") != stamp:
+            if not User.exists(uid=session["uid"]):
+                # Weird! Log them out.
+                from rophako.modules.account import logout
+                logout()
+                return
+
+            db = User.get_user(uid=session["uid"])
+            session["username"]   = db["username"]
+            session["name"]       = db["name"]
+            session["role"]       = db["role"]
+            session["user_stamp"] = stamp
 
     # Copy session params into g.info. The only people who should touch the
     # session are the login/out pages.
@@ -119,6 +308,72 @@ def before_request():
         g.info["session"][key] = session[key]
 
 
+@app.after_request
+def add_validators(response):
+    """Add the ETag and Last-Modified headers to pages that use
+    `rophako.utils.not_modified()`.
+
+    This is registered before `page_cache_store()` so that it runs after it,
+    once the page's CSRF token (part of the ETag) has been filled in."""
+    mtimes = g.get("validator")
+    if mtimes is None or response.status_code not in [200, 304]:
+        return response
+
+    # Compression changes the bytes on the wire, so the tag is weak. Browsers
+    # must always check back with us before using their copy.
+    response.set_etag(rophako.utils.page_etag(mtimes), weak=True)
+    response.last_modified = int(max(mtimes))
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+@app.after_request
+def page_cache_store(response):
+    """Save a freshly rendered page into the page cache."""
+    if not g.get("page_cache_key") or g.get("page_cache_hit"):
+        return response
+
+    if response.status_code == 304 or response.mimetype != "text/html" \
+        or response.direct_passthrough:
+        return response
+    html = response.get_data(as_text=True)
+
+    # Only whole pages that rendered fine, and that didn't show a flashed
+    # message to this visitor, are kept. They're stored with the versions of
+    # their tags from before they were rendered (see cache_tags()).
+    tags = g.get("page_cache_tags", dict())
+    if response.status_code == 200 and not session.get("_flashes") \
+        and tags is not None:
+        JsonDB.set_cache(g.page_cache_key, dict(
+            html=html,
+            tags=tags,
+            documents=g.get("validator_documents"),
+        ), expires=int(Config.cache.page_cache_lifetime))
+
+    response.set_data(
+        rophako.utils.fill_page_cache_slots(html, g.request_start)
+    )
+    return response
+
+
+@app.after_request
+def add_server_timing(response):
+    """Report how long the app spent on the request (up to the first byte,
+    for streamed pages) in the Server-Timing header."""
+    timings = ["app;dur={:.1f}".format((time.time() - g.request_start) * 1000)]
+    if g.get("page_cache_hit"):
+        timings.append('cache;desc="page cache hit"')
+    response.headers["Server-Timing"] = ", ".join(timings)
+    return response
+
+
+@app.teardown_request
+def discard_uploads(error=None):
+    """Delete the spooled files of any uploads that weren't used."""
+    for spool in getattr(request, "upload_spools", []):
+        spool.discard()
+
+
 @app.context_processor
 def after_request():
     """Called just before render_template. Inject g.info into the template vars."""
@@ -181,3 +436,8 @@ def not_found(error):
 @app.errorhandler(403)
 def forbidden(error):
     return render_template('errors/403.html', **g.info), 403
+
+
+@app.errorhandler(413)
+def too_large(error):
+    return render_template('errors/413.html', **g.info), 413
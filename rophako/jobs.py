@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+
+"""Background jobs.
+
+Slow work, like resizing uploaded photos, is handed off as a job so that the
+web page can respond right away. Job functions are registered by name with
+the `@task` decorator, and queued up with `enqueue()`:
+
+```python
+@Jobs.task("photo.crop")
+def recrop(key, x, y, length):
+    ...
+
+Jobs.enqueue("photo.crop", key=key, x=x, y=y, length=length)
+```
+
+The arguments must be JSON serializable, and the job can't rely on the Flask
+request: it may run after the request is long gone, in another process. Use
+`enqueue_later()` to run a job after a delay (e.g. to retry something).
+Jobs registered with `startup=True` also run (with no arguments) whenever the
+workers start, to pick up after the jobs that were lost when they last
+stopped.
+
+With `jobs.worker` turned on, jobs are pushed onto a Redis list and run by
+`scripts/worker.py`. Otherwise (or when Redis is down), each web server
+process runs its own jobs in a background thread."""
+
+import json
+import time
+import uuid
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from rophako.settings import Config
+import rophako.jsondb as JsonDB
+from rophako.log import logger
+
+# Job functions, by name.
+TASKS = dict()
+
+# The names of the jobs to run when the workers start.
+STARTUP_TASKS = list()
+
+# Jobs waiting for the local worker thread (see start_local_worker()).
+LOCAL_QUEUE = queue.Queue()
+LOCAL_WORKER = None
+LOCAL_LOCK = threading.Lock()
+
+
+def task(name, startup=False):
+    """Decorator to register a job function under a name.
+
+    With `startup`, the job is also run each time the workers start."""
+    def decorator(f):
+        TASKS[name] = f
+        if startup:
+            STARTUP_TASKS.append(name)
+        return f
+    return decorator
+
+
+def enqueue(name, **kwargs):
+    """Queue up a job to be run in the background."""
+    if not name in TASKS:
+        raise ValueError("Unknown job: {}".format(name))
+
+    job = dict(name=name, args=kwargs)
+    if Config.jobs.worker:
+        client = JsonDB.get_redis()
+        if client:
+            logger.debug("Queue job {} for the worker".format(name))
+            client.rpush(queue_key(), json.dumps(job))
+            return
+        logger.error("Can't send job {} to the worker without Redis; running it here instead.".format(name))
+
+    start_local_worker()
+    LOCAL_QUEUE.put(job)
+
+
+def enqueue_later(delay, name, **kwargs):
+    """Queue up a job to be run in the background after `delay` seconds."""
+    if not name in TASKS:
+        raise ValueError("Unknown job: {}".format(name))
+
+    if Config.jobs.worker:
+        client = JsonDB.get_redis()
+        if client:
+            # The ID keeps identical jobs apart in the sorted set.
+            logger.debug("Queue job {} for the worker in {}s".format(name, delay))
+            job = dict(name=name, args=kwargs, id=uuid.uuid4().hex)
+            client.zadd(later_key(), {json.dumps(job): time.time() + delay})
+            return
+        logger.error("Can't send job {} to the worker without Redis; running it here instead.".format(name))
+
+    timer = threading.Timer(delay, enqueue, args=[name], kwargs=kwargs)
+    timer.daemon = True
+    timer.start()
+
+
+def run(job):
+    """Run a job. Returns True if it succeeded.
+
+    A job that fails is logged and dropped."""
+    name = job.get("name")
+    if not name in TASKS:
+        logger.error("Can't run unknown job: {}".format(name))
+        return False
+
+    logger.debug("Running job {}".format(name))
+    try:
+        TASKS[name](**job["args"])
+        return True
+    except Exception as e:
+        logger.exception("Job {} failed: {}".format(name, e))
+        return False
+
+
+def work(timeout=5):
+    """Run jobs from the Redis queue, forever. This is the main loop of
+    `scripts/worker.py`."""
+    client = JsonDB.get_redis()
+    if not client:
+        raise Exception("The job worker needs Redis!")
+
+    for name in STARTUP_TASKS:
+        run(dict(name=name, args=dict()))
+
+    logger.info("Waiting for jobs on {}".format(queue_key()))
+    while True:
+        queue_due_jobs(client)
+        item = client.blpop(queue_key(), timeout=timeout)
+        if item is None:
+            continue
+        run(json.loads(item[1].decode("utf-8")))
+
+
+def queue_due_jobs(client):
+    """Move the delayed jobs (see enqueue_later()) that are due onto the job
+    queue."""
+    for item in client.zrangebyscore(later_key(), 0, time.time()):
+        # Only the worker that takes it off the list gets to queue it.
+        if client.zrem(later_key(), item):
+            client.rpush(queue_key(), item)
+
+
+def queue_key():
+    """The Redis key of the job queue."""
+    return Config.db.redis_prefix + "jobs"
+
+
+def later_key():
+    """The Redis key of the delayed jobs, sorted by when they're due."""
+    return Config.db.redis_prefix + "jobs:later"
+
+
+def start_local_worker():
+    """Start the background thread for running jobs in this process, if it
+    isn't running already. The first time, it starts on the startup jobs."""
+    global LOCAL_WORKER
+    if LOCAL_WORKER is not None and LOCAL_WORKER.is_alive():
+        return
+
+    with LOCAL_LOCK:
+        if LOCAL_WORKER is None:
+            for name in STARTUP_TASKS:
+                LOCAL_QUEUE.put(dict(name=name, args=dict()))
+        if LOCAL_WORKER is None or not LOCAL_WORKER.is_alive():
+            LOCAL_WORKER = threading.Thread(target=local_worker,
+                name="rophako-jobs")
+            LOCAL_WORKER.daemon = True
+            LOCAL_WORKER.start()
+
+
+def local_worker():
+    """Main loop of the local worker thread."""
+    while True:
+        job = LOCAL_QUEUE.get()
+        run(job)
+        LOCAL_QUEUE.task_done()
+
+
+def wait_local():
+    """Wait until the local worker thread has finished all its jobs."""
+    LOCAL_QUEUE.join()
@@ -107,6 +107,14 @@ def exists(document):
     return os.path.isfile(path)
 
 
+def mtime(document):
+    """Get the last modified time of a document, or 0 if it doesn't exist."""
+    try:
+        return os.stat(mkpath(document)).st_mtime
+    except OSError:
+        return 0
+
+
 def list_docs(path, recursive=False):
     """List all the documents at the path."""
     root = os.path.join(Config.db.db_root, path)
@@ -291,3 +299,54 @@ def unlock_cache(lock):
     if lock:
         lock.release()
         logger.debug("Cache lock released")
+
+
+############################################################################
+# Cache Tag Functions                                                      #
+############################################################################
+
+def get_tag_versions(tags):
+    """Get the current version numbers of a set of cache tags.
+
+    Cache tags are simple counters in Redis that are bumped any time the data
+    they describe changes (see `invalidate_tags()`). Anything built from that
+    data can remember the tag versions it saw, and is stale as soon as they
+    no longer match.
+
+    Returns a dict of tag names to version numbers, or None if Redis is not
+    available."""
+    client = get_redis()
+    if not client:
+        return None
+
+    tags = sorted(tags)
+    if len(tags) == 0:
+        return {}
+
+    keys = [ Config.db.redis_prefix + "tag:" + tag for tag in tags ]
+    try:
+        values = client.mget(keys)
+    except:
+        logger.debug("Redis exception: couldn't get_tag_versions {}".format(tags))
+        return None
+
+    return { tag: int(value or 0) for tag, value in zip(tags, values) }
+
+
+def invalidate_tags(*tags):
+    """Bump the version of one or more cache tags.
+
+    This is called by the model functions that write to the DB, e.g. posting
+    a blog entry invalidates the tags `blog` and `post:<id>`."""
+    client = get_redis()
+    if not client:
+        return
+
+    logger.debug("Invalidate cache tags: {}".format(tags))
+    try:
+        pipe = client.pipeline()
+        for tag in tags:
+            pipe.incr(Config.db.redis_prefix + "tag:" + tag)
+        pipe.execute()
+    except:
+        logger.error("Redis exception: couldn't invalidate_tags {}".format(tags))
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, absolute_import
+
+"""Outgoing e-mail.
+
+E-mails are sent by a background job (see rophako.jobs), so pages don't have
+to wait on the mail server. Each batch of e-mails goes out over a single SMTP
+connection, and the ones that can't be sent are tried again later.
+
+Use `rophako.utils.send_email()` to send an e-mail; it renders the message
+and queues it up here."""
+
+import smtplib
+import socket
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from markupsafe import Markup
+
+from rophako.settings import Config
+import rophako.jobs as Jobs
+from rophako.log import logger
+
+
+def queue(messages):
+    """Queue up a batch of e-mails to be sent in the background.
+
+    Each message is a dict with the `to` addresses, `sender`, `subject`,
+    `reply_to` (or None), the `text` and `html` versions of the body, and the
+    `slots` to fill in for each recipient: a dict of addresses to dicts of
+    slot names to values. Each `%name%` in the body is replaced by the value
+    when it's sent, so one message can go to any number of recipients
+    without being rendered again for each one."""
+    if Config.mail.method != "smtp" or len(messages) == 0:
+        return
+    Jobs.enqueue("mail.send", messages=messages)
+
+
+@Jobs.task("mail.send")
+def deliver(messages, attempt=1):
+    """Job that sends a batch of e-mails over one SMTP connection.
+
+    The ones that couldn't be sent for a reason that might go away (the
+    server is down, or said to try again later) are retried by a new job."""
+    logger.info("Send e-mails to {} recipients (attempt {})".format(
+        sum([ len(message["to"]) for message in messages ]), attempt))
+    retry = list()
+    server = None
+    try:
+        server = smtplib.SMTP(Config.mail.server, Config.mail.port,
+            timeout=Config.mail.timeout)
+    except (smtplib.SMTPException, socket.error) as e:
+        logger.error("Couldn't connect to the mail server: {}".format(e))
+        retry = messages
+
+    lost = server is None
+    for message in messages if server is not None else []:
+        failed = list()
+        text = shared_text(message)
+        for address in message["to"]:
+            if lost:
+                failed.append(address)
+                continue
+
+            try:
+                server.sendmail(message["sender"], [address],
+                    make_mime(message, address, text).as_string())
+            except smtplib.SMTPRecipientsRefused as e:
+                logger.error("E-mail to {} was refused: {}".format(address, e))
+            except smtplib.SMTPResponseException as e:
+                logger.error("Couldn't send e-mail to {}: {}".format(address, e))
+                if e.smtp_code < 500:
+                    failed.append(address)
+            except (smtplib.SMTPException, socket.error) as e:
+                # We've lost the server; try the rest again later.
+                logger.error("Lost the mail server while sending: {}".format(e))
+                lost = True
+                failed.append(address)
+
+        if len(failed):
+            retry.append(dict(message, to=failed))
+
+    if server is not None:
+        try:
+            server.quit()
+        except (smtplib.SMTPException, socket.error):
+            server.close()
+
+    if len(retry):
+        try_again(retry, attempt)
+
+
+def try_again(messages, attempt):
+    """Send e-mails again later, waiting twice as long each time, up to
+    `mail.retries` times."""
+    if attempt > int(Config.mail.retries):
+        logger.error("Giving up on e-mails to {} recipients after {} attempts.".format(
+            sum([ len(message["to"]) for message in messages ]), attempt))
+        return
+
+    delay = int(Config.mail.retry_delay) * 2 ** (attempt - 1)
+    logger.info("Retrying e-mails in {}s".format(delay))
+    Jobs.enqueue_later(delay, "mail.send", messages=messages, attempt=attempt+1)
+
+
+def shared_text(message):
+    """Make the plain text MIME part of a message, if it's the same for all
+    the recipients (it has no slots to fill in), so it's only encoded once.
+    Returns None otherwise."""
+    for slots in message["slots"].values():
+        for name in slots:
+            if "%{}%".format(name) in message["text"]:
+                return None
+    return MIMEText(message["text"], "plain", "utf-8")
+
+
+def fill_slots(content, slots, escape=False):
+    """Fill in the `%name%` slots of an e-mail body for one recipient."""
+    for name, value in slots.items():
+        if escape:
+            value = Markup.escape(value)
+        content = content.replace("%{}%".format(name), value)
+    return content
+
+
+def make_mime(message, address, text=None):
+    """Build the MIME message for one recipient of an e-mail (see queue()).
+
+    `text` is the plain text part from shared_text(), if it has one."""
+    slots = message["slots"].get(address, {})
+
+    msg = MIMEMultipart("alternative")
+    msg.set_charset("utf-8")
+
+    msg["Subject"] = message["subject"]
+    msg["From"] = message["sender"]
+    msg["To"] = address
+    if message["reply_to"] is not None:
+        msg["Reply-To"] = message["reply_to"]
+
+    if text is None:
+        text = MIMEText(fill_slots(message["text"], slots), "plain", "utf-8")
+    msg.attach(text)
+
+    html = MIMEText(fill_slots(message["html"], slots, escape=True), "html",
+        "utf-8")
+    msg.attach(html)
+
+    return msg
@@ -4,11 +4,13 @@ from __future__ import unicode_literals, absolute_import
 """Blog models."""
 
 from flask import g
+import datetime
 import time
 import re
 import glob
 import os
 import sys
+import pytz
 
 if sys.version_info[0] > 2:
     def unicode(s):
@@ -119,6 +121,8 @@ def rebuild_index():
         update_index(post_id, db, index, False)
 
     JsonDB.commit("blog/index", index)
+    rebuild_archive()
+    JsonDB.invalidate_tags("blog")
     return index
 
 
@@ -133,6 +137,7 @@ def update_index(post_id, post, index=None, commit=True):
     if index is None:
         index = get_index(drafts=True)
 
+    old = index.get(post_id)
     index[post_id] = dict(
         fid        = post["fid"],
         time       = post["time"] or int(time.time()),
@@ -144,6 +149,161 @@ def update_index(post_id, post, index=None, commit=True):
     )
     if commit:
         JsonDB.commit("blog/index", index)
+        update_archive(post_id, old, index[post_id])
+
+
+def get_archive():
+    """Get the blog archive: the posts grouped by calendar month.
+
+    The archive is kept up to date whenever the index changes, so that the
+    archive page doesn't have to sort through the whole index itself. It has
+    the format:
+
+    ```
+    [
+        {
+            month: "2014-05",
+            month_friendly: "May 2014",
+            posts: [ list of posts in the month, newest first; each has
+                     the same fields as in the index, plus its `id` ]
+        },
+        ...
+    ]
+    ```
+
+    The months are newest first, and posts that the current user can't see
+    (same as in `get_index()`) are left out."""
+    db = JsonDB.get("blog/archive") if JsonDB.exists("blog/archive") else None
+    if db is None or db.get("timezone") != Config.site.timezone:
+        # The months depend on the site's time zone.
+        db = rebuild_archive()
+
+    result = list()
+    for month in db["months"]:
+        posts = list()
+        for post in month["posts"]:
+            if post["privacy"] == "draft":
+                continue
+            elif post["privacy"] == "private" and not g.info["session"]["login"]:
+                continue
+            posts.append(post)
+
+        if len(posts):
+            month["posts"] = posts
+            result.append(month)
+
+    return result
+
+
+def rebuild_archive():
+    """Rebuild the blog archive from the index."""
+    index = JsonDB.get("blog/index") if JsonDB.exists("blog/index") else {}
+
+    # Group by calendar month.
+    groups = dict()
+    for post_id, data in index.items():
+        archive_post(groups, post_id, data)
+
+    # Sort the months, and the posts in them, newest first.
+    months = list()
+    for date in sorted(groups.keys(), reverse=True):
+        groups[date]["posts"].sort(key=lambda x: x["time"], reverse=True)
+        months.append(groups[date])
+
+    db = dict(timezone=Config.site.timezone, months=months)
+    JsonDB.commit("blog/archive", db)
+    return db
+
+
+def update_archive(post_id, old, new):
+    """Update the blog archive for one post that changed, given its `old` and
+    `new` index entries (either may be None, for a new or deleted post).
+
+    Only the months that the post was and is in are touched."""
+    post_id = str(post_id) # Same as the index keys, once it's saved as JSON.
+    if not JsonDB.exists("blog/archive"):
+        rebuild_archive()
+        return
+
+    lock = JsonDB.lock_cache("blog/archive/lock")
+    try:
+        db = JsonDB.get("blog/archive")
+        if db.get("timezone") != Config.site.timezone:
+            rebuild_archive()
+            return
+        groups = { month["month"]: month for month in db["months"] }
+
+        # Take it out of the month it was in.
+        if old is not None:
+            date = archive_month(old["time"])[0]
+            if date in groups:
+                groups[date]["posts"] = [ post for post in groups[date]["posts"]
+                    if post["id"] != post_id ]
+                if len(groups[date]["posts"]) == 0:
+                    del groups[date]
+
+        # And put it in the one it's in now.
+        if new is not None:
+            date = archive_post(groups, post_id, new)
+            groups[date]["posts"].sort(key=lambda x: x["time"], reverse=True)
+
+        db["months"] = [ groups[date]
+            for date in sorted(groups.keys(), reverse=True) ]
+        JsonDB.commit("blog/archive", db)
+    finally:
+        JsonDB.unlock_cache(lock)
+
+
+def archive_post(groups, post_id, data):
+    """Add a post's index entry to its month in `groups` (a dict of archive
+    months by date). Returns the date of its month."""
+    date, friendly = archive_month(data["time"])
+    if not date in groups:
+        groups[date] = dict(
+            month=date,
+            month_friendly=friendly,
+            posts=list(),
+        )
+
+    post = dict(data)
+    post["id"] = post_id
+    groups[date]["posts"].append(post)
+    return date
+
+
+def archive_month(epoch):
+    """Get the archive month of a time stamp, in the site's time zone: its
+    date (e.g. "2014-05") and friendly name (e.g. "May 2014")."""
+    ts = datetime.datetime.fromtimestamp(epoch, pytz.utc).astimezone(Config.tz)
+    return ts.strftime("%Y-%m"), ts.strftime("%B %Y")
+
+
+def index_mtime():
+    """Get the last modified time of the blog index."""
+    return JsonDB.mtime("blog/index")
+
+
+def get_feed_cache(name):
+    """Get a cached RSS/Atom feed.
+
+    Returns None if the feed isn't cached, or if the blog index has changed
+    since it was."""
+    cached = JsonDB.get_cache("blog/feed/{}".format(name))
+    if not cached or cached["mtime"] != index_mtime():
+        return None
+    return cached["xml"]
+
+
+def set_feed_cache(name, mtime, xml):
+    """Cache an RSS/Atom feed.
+
+    Args:
+        name (str): the name of the feed, from the blog module.
+        mtime (float): the `index_mtime()` from before the feed was written.
+        xml (str): the serialized feed.
+    """
+    JsonDB.set_cache("blog/feed/{}".format(name), dict(mtime=mtime, xml=xml),
+        expires=60*60*24)
 
 
 def get_categories():
@@ -251,6 +411,7 @@ def post_entry(post_id, fid, epoch, author, subject, avatar, categories,
 
     # Update the index cache.
     update_index(post_id, db, index)
+    JsonDB.invalidate_tags("blog", "post:{}".format(post_id))
 
     return post_id, fid
 
@@ -267,8 +428,10 @@ def delete_entry(post_id):
     JsonDB.delete("blog/entries/{}".format(post_id))
 
     # Update the index cache.
-    del index[str(post_id)] # Python JSON dict keys must be strings, never ints
+    old = index.pop(str(post_id)) # Python JSON dict keys must be strings, never ints
     JsonDB.commit("blog/index", index)
+    update_archive(post_id, old, None)
+    JsonDB.invalidate_tags("blog", "post:{}".format(post_id))
 
 
 def resolve_id(fid, drafts=False):
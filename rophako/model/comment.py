@@ -3,7 +3,7 @@ from __future__ import unicode_literals, absolute_import
 
 """Commenting models."""
 
-from flask import url_for, session
+from flask import url_for, session, request
 from itsdangerous import URLSafeSerializer
 import time
 import hashlib
@@ -16,7 +16,7 @@ from rophako.settings import Config
 import rophako.jsondb as JsonDB
 import rophako.model.user as User
 import rophako.model.emoticons as Emoticons
-from rophako.utils import send_email, render_markdown
+from rophako.utils import make_email, send_emails, render_markdown
 from rophako.log import logger
 
 def deletion_token():
@@ -50,9 +50,12 @@ def add_comment(thread, uid, name, subject, message, url, time, ip,
         url (str): the URL where the comment can be read (i.e. the blog post)
         time (int): epoch time of the comment.
         ip (str): the user's IP address.
-        token (str): the user's session's comment deletion token.
+        token (str): the user's session's comment deletion token. By default
+            it's the session's own, made now if it doesn't have one yet.
         image (str): the URL to a Gravatar image, if any.
     """
+    if token is None:
+        token = deletion_token()
 
     # Get the comments for this thread.
     comments = get_comments(thread)
@@ -76,12 +79,15 @@ def add_comment(thread, uid, name, subject, message, url, time, ip,
 
     # Get info about the commenter.
     if uid > 0:
-        user = User.get_user(uid=uid)
+        user = User.get_profile(uid)
         if user:
             name = user["name"]
 
+    # The e-mails all go out together in the background.
+    emails = list()
+
     # Send the e-mail to the site admins.
-    send_email(
+    emails.append(make_email(
         to=Config.site.notify_address,
         subject="Comment Added: {}".format(subject),
         message="""{name} has left a comment on: {subject}
@@ -103,16 +109,14 @@ Was this comment spam? [Delete it]({deletion_link}).""".format(
                 _external=True,
             )
         ),
-    )
+    ))
 
-    # Notify any subscribers.
+    # Notify any subscribers. The e-mail is the same for all of them except
+    # for the unsubscribe link, which is filled in for each one.
     subs = get_subscribers(thread)
-    for sub in subs.keys():
-        # Make the unsubscribe link.
-        unsub = url_for("comment.unsubscribe", thread=thread, who=sub, _external=True)
-
-        send_email(
-            to=sub,
+    if len(subs):
+        emails.append(make_email(
+            to=list(subs.keys()),
             subject="New Comment: {}".format(subject),
             message="""Hello,
 
@@ -128,14 +132,18 @@ To view this comment, please go to <{url}>""".format(
                 subject=subject,
                 message=message,
                 url=url,
-                unsub=unsub,
             ),
             footer="You received this e-mail because you subscribed to the "
                 "comment thread that this comment was added to. You may "
-                "[**unsubscribe**]({unsub}) if you like.".format(
-                unsub=unsub,
-            ),
-        )
+                "[**unsubscribe**](%unsubscribe%) if you like.",
+            slots={
+                sub: dict(unsubscribe=url_for("comment.unsubscribe",
+                    thread=thread, who=sub, _external=True))
+                for sub in subs.keys()
+            },
+        ))
+
+    send_emails(emails)
 
 
 def get_comment(thread, cid):
@@ -158,6 +166,7 @@ def delete_comment(thread, cid):
     if cid in comments:
         del comments[cid]
         write_comments(thread, comments)
+        JsonDB.del_cache("comments/html/{}/{}".format(thread, cid))
 
 
 def make_quick_delete_token(thread, cid):
@@ -230,8 +239,11 @@ def is_editable(thread, cid, comment=None):
         if not comment:
             return False
 
-    # Make sure the comment's token matches the user's, or bail.
-    if comment.get("token", "x") != deletion_token():
+    # Make sure the comment's token matches the user's, or bail. Visitors
+    # only get a token when they post a comment, so don't make one here:
+    # sessions that hold one aren't served from the page cache.
+    token = session.get("comment_token")
+    if token is None or comment.get("token") != token:
         return False
 
     # And finally, make sure the comment is new enough.
@@ -240,8 +252,19 @@ def is_editable(thread, cid, comment=None):
 
 def count_comments(thread):
     """Count the comments on a thread."""
-    comments = get_comments(thread)
-    return len(comments.keys())
+    return count_comments_many([thread])[thread]
+
+
+def count_comments_many(threads):
+    """Count the comments on several threads at once, from the counts index
+    (see get_counts()).
+
+    Returns a dict of thread names to their comment counts."""
+    counts = get_counts()
+    return {
+        thread: counts[thread]["count"] if thread in counts else 0
+        for thread in threads
+    }
 
 
 def add_subscriber(thread, email):
@@ -291,6 +314,100 @@ def format_message(message):
     return message
 
 
+def formatted_message(thread, cid, message):
+    """Get a comment's message formatted for display.
+
+    The HTML is cached, so each comment is only formatted again when its
+    message is edited (or the emoticons it links to would change)."""
+    digest = hashlib.md5("\n".join([
+        request.url_root, Config.emoticons.theme, message,
+    ]).encode("utf-8")).hexdigest()
+
+    key = "comments/html/{}/{}".format(thread, cid)
+    cached = JsonDB.get_cache(key)
+    if cached and cached["digest"] == digest:
+        return cached["html"]
+
+    html = format_message(message)
+    JsonDB.set_cache(key, dict(digest=digest, html=html), expires=60*60*24*7)
+    return html
+
+
+def get_page(thread, after=None, limit=0, newest=False):
+    """Get a page of the comments on a thread.
+
+    Comments are in the order they were posted, or the newest first if
+    `newest` is True. Pages are found by a cursor, which points at the last
+    comment of the page before, so comments that are added or deleted in the
+    meantime don't make the pages skip or repeat any.
+
+    Parameters:
+        thread (str): the unique comment thread name.
+        after (str): the cursor of the page before (None for the first page).
+        limit (int): the number of comments on a page (0 for all of them).
+        newest (bool): put the newest comments first.
+
+    Returns:
+        tuple: (comments, total, cursor) -- a list of the comments on the page
+            (with their `id`s), the number of comments on the thread, and the
+            cursor of the next page (None if this is the last one).
+
+    Raises ValueError if the cursor isn't valid."""
+    comments = get_comments(thread)
+    order = sorted(comments, key=lambda cid: comment_position(cid, comments[cid]),
+        reverse=newest)
+
+    if after is not None:
+        position = parse_cursor(after)
+        if newest:
+            order = [ cid for cid in order
+                if comment_position(cid, comments[cid]) < position ]
+        else:
+            order = [ cid for cid in order
+                if comment_position(cid, comments[cid]) > position ]
+
+    cursor = None
+    if limit > 0 and len(order) > limit:
+        order = order[:limit]
+        cursor = "{}-{}".format(*comment_position(order[-1], comments[order[-1]]))
+
+    page = list()
+    for cid in order:
+        comment = dict(comments[cid])
+        comment["id"] = cid
+        page.append(comment)
+    return page, len(comments), cursor
+
+
+def comment_position(cid, comment):
+    """Where a comment sorts in its thread: by time, and then by ID for the
+    ones posted in the same second."""
+    return (int(comment["time"]), cid)
+
+
+def parse_cursor(cursor):
+    """Get the position that a page cursor (from get_page()) points at."""
+    try:
+        time, cid = cursor.split("-", 1)
+        return (int(time), cid)
+    except (AttributeError, ValueError):
+        raise ValueError("Invalid comment cursor: {}".format(cursor))
+
+
+def thread_documents(thread):
+    """Get the names of the DB documents that a comment thread is built from
+    (for `rophako.utils.not_modified()`): the thread, and the profiles of
+    the users who commented on it. The commenters come from the counts index,
+    so the thread itself isn't loaded."""
+    entry = get_counts().get(thread, dict())
+    uids = entry.get("uids")
+    if uids is None and len(entry):
+        # An index from before it listed the commenters.
+        uids = commenter_uids(get_comments(thread))
+    return ["comments/threads/{}".format(thread)] + \
+        User.profile_documents(uids or [])
+
+
 def get_comments(thread):
     """Get the comment thread."""
     doc = "comments/threads/{}".format(thread)
@@ -301,11 +418,68 @@ def get_comments(thread):
 
 def write_comments(thread, comments):
     """Save the comments DB."""
+    JsonDB.invalidate_tags("thread:{}".format(thread))
+    update_counts(thread, comments)
     if len(comments.keys()) == 0:
         return JsonDB.delete("comments/threads/{}".format(thread))
     return JsonDB.commit("comments/threads/{}".format(thread), comments)
 
 
+def get_counts():
+    """Get the comment counts index, which keeps the number of comments on
+    each thread so listing pages don't have to load every thread:
+
+    `{ thread: { "count": number of comments, "last": time of the newest,
+                 "uids": the users who commented (not guests) } }`
+
+    It's built from the comment threads the first time it's needed."""
+    counts = JsonDB.get("comments/counts")
+    if counts is None:
+        counts = rebuild_counts()
+    return counts
+
+
+def update_counts(thread, comments):
+    """Update a thread's entry in the comment counts index."""
+    lock = JsonDB.lock_cache("comments/counts/lock")
+    try:
+        counts = get_counts()
+        if len(comments.keys()) == 0:
+            counts.pop(thread, None)
+        else:
+            counts[thread] = thread_count(comments)
+        JsonDB.commit("comments/counts", counts)
+    finally:
+        JsonDB.unlock_cache(lock)
+
+
+def rebuild_counts():
+    """Rebuild the comment counts index from all the comment threads."""
+    logger.info("Rebuilding the comment counts index")
+    counts = dict()
+    for thread in JsonDB.list_docs("comments/threads"):
+        comments = get_comments(thread)
+        if len(comments.keys()) > 0:
+            counts[thread] = thread_count(comments)
+    JsonDB.commit("comments/counts", counts)
+    return counts
+
+
+def thread_count(comments):
+    """Get the counts index entry of a comment thread."""
+    return dict(
+        count=len(comments.keys()),
+        last=max([ comment["time"] for comment in comments.values() ]),
+        uids=commenter_uids(comments),
+    )
+
+
+def commenter_uids(comments):
+    """Get the user IDs of the logged-in users who posted in a thread."""
+    return sorted(set([ comment["uid"] for comment in comments.values()
+        if comment["uid"] > 0 ]))
+
+
 def get_subscribers(thread):
     """Get the subscribers to a comment thread."""
     doc = "comments/subscribers/{}".format(thread)
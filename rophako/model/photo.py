@@ -9,10 +9,19 @@ import time
 import requests
 from PIL import Image
 import hashlib
+import re
+import struct
+import io
 import random
+import uuid
+import atexit
+import threading
+import multiprocessing
+from contextlib import contextmanager
 
-from rophako.settings import Config
+from rophako.settings import Config, init_worker
 import rophako.jsondb as JsonDB
+import rophako.jobs as Jobs
 from rophako.utils import sanitize_name, remote_addr
 from rophako.log import logger
 
@@ -23,33 +32,78 @@ PHOTO_SCALES = dict(
     avatar=int(Config.photo.width_avatar),
 )
 
+# Resampling filters for scaling down to each photo size. The large size is
+# the one people actually look at, so it gets the sharpest filter; the little
+# avatars can't tell the difference and get a cheaper one.
+PHOTO_FILTERS = dict(
+    large=Image.LANCZOS,
+    thumb=Image.LANCZOS,
+    avatar=Image.BICUBIC,
+)
+
+# When scaling down by a lot, first shrink the image by a whole factor with a
+# fast box filter, as long as it stays at least this many times bigger than
+# the target size, and only use the real filter for the rest of the way.
+REDUCING_GAP = 3.0
+
+# How rotate_photo() turns the image for each direction.
+ROTATIONS = {
+    "left":  Image.ROTATE_90,
+    "right": Image.ROTATE_270,
+    "180":   Image.ROTATE_180,
+}
+
+# The EXIF orientation tag, and how to turn a photo upright for each of its
+# values (1 means it's upright already).
+EXIF_ORIENTATION = 0x0112
+ORIENTATION_TRANSPOSE = {
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90,
+}
+
+# The new EXIF orientation of a photo after rotate_photo(), by direction and
+# old orientation.
+EXIF_ROTATIONS = {
+    "left":  {1: 8, 2: 5, 3: 6, 4: 7, 5: 4, 6: 1, 7: 2, 8: 3},
+    "right": {1: 6, 2: 7, 3: 8, 4: 5, 5: 2, 6: 3, 7: 4, 8: 1},
+    "180":   {1: 3, 2: 4, 3: 1, 4: 2, 5: 7, 6: 8, 7: 5, 8: 6},
+}
+
+# Incoming photos are saved this many bytes at a time.
+CHUNK_SIZE = 64 * 1024
+
+# The image formats that may be uploaded (as PIL names them).
+PHOTO_FORMATS = ["JPEG", "PNG", "GIF"]
+
+# The sizes that get responsive versions (see make_variants()), and the
+# extra formats this copy of PIL can make them in (see variant_formats()).
+VARIANT_SIZES = ["large", "thumb"]
+VARIANT_FORMATS = None
+
+# Pool of worker processes for resizing photos (see get_pool()).
+POOL = None
+
+# Only one thread at a time may add photos or save the results of a job.
+ALBUMS_LOCK = threading.Lock()
+
 
 def list_albums():
     """Retrieve a sorted list of the photo albums."""
-    index = get_index()
+    catalog = get_catalog()
     result = []
 
-    # Missing settings?
-    if not "settings" in index:
-        index["settings"] = dict()
-
-    for album in index["album-order"]:
-        if not album in index["settings"]:
-            # Need to initialize its settings.
-            index["settings"][album] = dict(
-                format="classic",
-                description="",
-            )
-            write_index(index)
-
-        cover = index["covers"][album]
-        pic = index["albums"][album][cover]["thumb"]
+    for album in catalog["album-order"]:
+        data = catalog["albums"][album]
         result.append(dict(
             name=album,
-            format=index["settings"][album]["format"],
-            description=index["settings"][album]["description"],
-            cover=pic,
-            data=index["albums"][album],
+            format=data["format"],
+            description=data["description"],
+            cover=data["cover-thumb"],
         ))
 
     return result
@@ -57,19 +111,17 @@ def list_albums():
 
 def get_album(name):
     """Get details about an album."""
-    index = get_index()
+    catalog = get_catalog()
 
-    if not name in index["albums"]:
+    if not name in catalog["albums"]:
         return None
 
-    album = index["albums"][name]
-    cover = index["covers"][name]
-
+    data = catalog["albums"][name]
     return dict(
         name=name,
-        format=index["settings"][name]["format"],
-        description=index["settings"][name]["description"],
-        cover=album[cover]["thumb"],
+        format=data["format"],
+        description=data["description"],
+        cover=data["cover-thumb"],
     )
 
 
@@ -80,53 +132,50 @@ def rename_album(old_name, new_name):
     album's name."""
     old_name = sanitize_name(old_name)
     new_name = sanitize_name(new_name)
-    index = get_index()
-
-    # New name is unique?
-    if new_name in index["albums"]:
-        logger.error("Can't rename album: new name already exists!")
-        return False
-
-    def transfer_key(obj, old_key, new_key):
-        # Reusable function to do a simple move on a dict key.
-        obj[new_key] = obj[old_key]
-        del obj[old_key]
-
-    # Simple moves.
-    transfer_key(index["albums"], old_name, new_name)
-    transfer_key(index["covers"], old_name, new_name)
-    transfer_key(index["photo-order"], old_name, new_name)
-    transfer_key(index["settings"], old_name, new_name)
-
-    # Update the photo -> album maps.
-    for photo in index["map"]:
-        if index["map"][photo] == old_name:
-            index["map"][photo] = new_name
-
-    # Fix the album ordering.
-    new_order = list()
-    for name in index["album-order"]:
-        if name == old_name:
-            name = new_name
-        new_order.append(name)
-    index["album-order"] = new_order
-
-    # And save.
-    write_index(index)
-    return True
+    with albums_locked():
+        catalog = get_catalog()
+
+        # New name is unique?
+        if new_name in catalog["albums"]:
+            logger.error("Can't rename album: new name already exists!")
+            return False
+
+        # Move the album's own document.
+        shard = get_shard(old_name)
+        shard["name"] = new_name
+        write_shard(new_name, shard)
+        JsonDB.delete(shard_document(old_name))
+
+        # Update the photo -> album maps.
+        photo_map = get_map()
+        for key in shard["order"]:
+            photo_map[key] = new_name
+        write_map(photo_map)
+
+        # Fix the catalog and the album ordering.
+        catalog["albums"][new_name] = catalog["albums"].pop(old_name)
+        catalog["album-order"] = [
+            new_name if name == old_name else name
+            for name in catalog["album-order"]
+        ]
+
+        # And save.
+        write_catalog(catalog)
+        JsonDB.invalidate_tags("album:{}".format(old_name), "album:{}".format(new_name))
+        return True
 
 
 def list_photos(album):
     """List the photos in an album."""
     album = sanitize_name(album)
-    index = get_index()
+    shard = get_shard(album)
 
-    if not album in index["albums"]:
+    if shard is None:
         return None
 
     result = []
-    for key in index["photo-order"][album]:
-        data = index["albums"][album][key]
+    for key in shard["order"]:
+        data = shard["photos"][key]
         result.append(dict(
             key=key,
             data=data,
@@ -137,23 +186,23 @@ def list_photos(album):
 
 def photo_exists(key):
     """Query whether a photo exists in the album."""
-    index = get_index()
-    return key in index["map"]
+    return key in get_map()
 
 
 def get_photo(key):
     """Look up a photo by key. Returns None if not found."""
-    index = get_index()
+    photo_map = get_map()
     photo = None
-    if key in index["map"]:
-        album = index["map"][key]
-        if album in index["albums"] and key in index["albums"][album]:
-            photo = index["albums"][album][key]
+    if key in photo_map:
+        album = photo_map[key]
+        shard = get_shard(album)
+        if shard and key in shard["photos"]:
+            photo = shard["photos"][key]
         else:
             # The map is wrong!
             logger.error("Photo album map is wrong; key {} not found in album {}!".format(key, album))
-            del index["map"][key]
-            write_index(index)
+            del photo_map[key]
+            write_map(photo_map)
 
     if not photo:
         return None
@@ -161,44 +210,41 @@ def get_photo(key):
     # Inject additional information about the photo:
     # What position it's at in the album, how many photos total, and the photo
     # IDs of its siblings.
-    siblings = index["photo-order"][album]
-    i = 0
-    for pid in siblings:
-        if pid == key:
-            # We found us! Find the siblings.
-            sprev, snext = None, None
-            if i == 0:
-                # We're the first photo. So previous is the last!
-                sprev = siblings[-1]
-                if len(siblings) > i+1:
-                    snext = siblings[i+1]
-                else:
-                    snext = key
-            elif i == len(siblings)-1:
-                # We're the last. So next is first!
-                sprev = siblings[i-1]
-                snext = siblings[0]
-            else:
-                # Right in the middle.
-                sprev = siblings[i-1]
-                snext = siblings[i+1]
-
-            # Inject.
-            photo["album"] = album
-            photo["position"] = i+1
-            photo["siblings"] = len(siblings)
-            photo["previous"] = sprev
-            photo["next"] = snext
-        i += 1
+    siblings = shard["order"]
+    positions = shard.get("positions") or album_positions(siblings)
+    i = positions.get(key)
+    if i is None:
+        logger.error("Photo {} is missing from the order of album {}!".format(key, album))
+        return photo
+
+    # The album wraps around: the first photo's previous is the last one.
+    photo["album"] = album
+    photo["position"] = i+1
+    photo["siblings"] = len(siblings)
+    photo["previous"] = siblings[i-1]
+    photo["next"] = siblings[(i+1) % len(siblings)]
 
     return photo
 
 
 def get_image_dimensions(pic):
-    """Use PIL to get the image's true dimensions."""
-    filename = os.path.join(Config.photo.root_private, pic["large"])
+    """Get the image's true dimensions (as it's shown, if it has an EXIF
+    orientation), from its recorded `dimensions`, or else by asking PIL."""
+    large = pic.get("dimensions", {}).get("large")
+    if large:
+        return large["width"], large["height"]
+    return image_size(pic["large"])
+
+
+def image_size(name):
+    """Get the dimensions of a photo file as it's shown (see
+    get_image_dimensions())."""
+    filename = os.path.join(Config.photo.root_private, name)
     img = Image.open(filename)
-    return img.size
+    width, height = img.size
+    if get_orientation(img) in [5, 6, 7, 8]:
+        return height, width
+    return width, height
 
 
 # def update_photo(album, key, data):
@@ -216,194 +262,293 @@ def get_image_dimensions(pic):
 
 
 def crop_photo(key, x, y, length):
-    """Change the crop coordinates of a photo and re-crop it."""
-    index = get_index()
-    if not key in index["map"]:
-        raise Exception("Can't crop photo: doesn't exist!")
+    """Change the crop coordinates of a photo and re-crop it.
 
-    album = index["map"][key]
+    The new thumbnails are made in the background; the photo is marked as
+    `processing` until they're ready."""
+    photo = get_photo(key)
+    if not photo:
+        raise Exception("Can't crop photo: doesn't exist!")
 
-    # Sanity check.
-    if not album in index["albums"]:
-        raise Exception("Can't find photo in album!")
+    logger.debug("Queue recropping photo {}".format(key))
+    edit_photo(key, dict(processing=int(time.time())))
+    Jobs.enqueue("photo.crop", key=key, x=x, y=y, length=length)
 
-    logger.debug("Recropping photo {}".format(key))
 
-    # Delete all the images except the large one.
-    for size in ["thumb", "avatar"]:
-        pic = index["albums"][album][key][size]
-        logger.debug("Delete {} size: {}".format(size, pic))
-        os.unlink(os.path.join(Config.photo.root_private, pic))
-
-    # Regenerate all the thumbnails.
-    large = index["albums"][album][key]["large"]
-    source = os.path.join(Config.photo.root_private, large)
-    for size in ["thumb", "avatar"]:
-        pic = resize_photo(source, size, crop=dict(
-            x=x,
-            y=y,
-            length=length,
-        ))
-        index["albums"][album][key][size] = pic
+@Jobs.task("photo.crop")
+def recrop_photo(key, x, y, length):
+    """Job that makes new thumbnails for crop_photo()."""
+    photo = get_photo(key)
+    if not photo:
+        logger.warning("Photo {} was deleted before it could be cropped.".format(key))
+        return
 
-    # Save changes.
-    write_index(index)
+    logger.debug("Recropping photo {}".format(key))
+    sizes = dict()
+    try:
+        # Regenerate all the thumbnails from the large size.
+        source = os.path.join(Config.photo.root_private, photo["large"])
+        sizes = make_squares(open_photo(source), photo_filetype(source),
+            crop=dict(x=x, y=y, length=length))
+    finally:
+        finish_photo(key, sizes)
 
 
 def set_album_cover(album, key):
     """Change the album's cover photo."""
     album = sanitize_name(album)
-    index = get_index()
-    logger.info("Changing album cover for {} to {}".format(album, key))
-    if album in index["albums"] and key in index["albums"][album]:
-        index["covers"][album] = key
-        write_index(index)
-        return
-    logger.error("Failed to change album index! Album or photo not found.")
+    with albums_locked():
+        catalog = get_catalog()
+        shard = get_shard(album)
+        logger.info("Changing album cover for {} to {}".format(album, key))
+        if album in catalog["albums"] and shard and key in shard["photos"]:
+            catalog["albums"][album]["cover"] = key
+            catalog["albums"][album]["cover-thumb"] = shard["photos"][key]["thumb"]
+            write_catalog(catalog)
+            JsonDB.invalidate_tags("album:{}".format(album))
+            return
+        logger.error("Failed to change album index! Album or photo not found.")
 
 
 def edit_photo(key, data):
     """Update a photo's data."""
-    index = get_index()
-    if not key in index["map"]:
-        logger.warning("Tried to delete photo {} but it wasn't found?".format(key))
-        return
+    with albums_locked():
+        photo_map = get_map()
+        if not key in photo_map:
+            logger.warning("Tried to edit photo {} but it wasn't found?".format(key))
+            return
 
-    album = index["map"][key]
+        album = photo_map[key]
+        shard = get_shard(album)
 
-    logger.info("Updating data for the photo {} from album {}".format(key, album))
-    index["albums"][album][key].update(data)
+        logger.info("Updating data for the photo {} from album {}".format(key, album))
+        shard["photos"][key].update(data)
 
-    write_index(index)
+        write_shard(album, shard)
+        if "thumb" in data:
+            update_cover_thumb(album, key, data["thumb"])
+    JsonDB.invalidate_tags("album:{}".format(album))
 
 
 def edit_album(album, data):
     """Update an album's settings (description, format, etc.)"""
     album = sanitize_name(album)
-    index = get_index()
-    if not album in index["albums"]:
-        logger.error("Failed to edit album: not found!")
-        return
+    with albums_locked():
+        catalog = get_catalog()
+        if not album in catalog["albums"]:
+            logger.error("Failed to edit album: not found!")
+            return
 
-    index["settings"][album].update(data)
-    write_index(index)
+        catalog["albums"][album].update(data)
+        write_catalog(catalog)
+        JsonDB.invalidate_tags("album:{}".format(album))
 
 
 def rotate_photo(key, rotate):
-    """Rotate a photo 90 degrees to the left or right."""
+    """Rotate a photo 90 degrees to the left or right.
+
+    This happens in the background; the photo is marked as `processing`
+    until it's done."""
     photo = get_photo(key)
     if not photo: return
 
-    # Degrees to rotate.
-    degrees = None
-    if rotate == "left":
-        degrees = 90
-    elif rotate == "right":
-        degrees = -90
-    else:
-        degrees = 180
+    edit_photo(key, dict(processing=int(time.time())))
+    Jobs.enqueue("photo.rotate", key=key, rotate=rotate)
+
+
+@Jobs.task("photo.rotate")
+def rerotate_photo(key, rotate):
+    """Job that rotates the photo files for rotate_photo()."""
+    photo = get_photo(key)
+    if not photo:
+        logger.warning("Photo {} was deleted before it could be rotated.".format(key))
+        return
 
     new_names = dict()
+    try:
+        new_names = rotate_files(photo, rotate)
+    finally:
+        # Save the new image names, and delete the old ones.
+        finish_photo(key, new_names)
+
+
+def rotate_files(photo, rotate):
+    """Make rotated copies of a photo's files.
+
+    The images are transposed, which doesn't lose any pixels, even when the
+    large size isn't square. The thumb and avatar are squares already, so
+    they're simply turned around too (which keeps their crop, and is much
+    cheaper than cutting new ones from the large size). With
+    `photo.exif_rotation`, the large size of a JPEG is rotated by changing its
+    EXIF orientation instead, so its image data isn't touched at all.
+
+    Returns a dict of the sizes' new file names (and their variants)."""
+    sizes = dict()
     for size in ["large", "thumb", "avatar"]:
         fname = os.path.join(Config.photo.root_private, photo[size])
-        logger.info("Rotating image {} by {} degrees.".format(fname, degrees))
+        logger.info("Rotating image {} to the {}.".format(fname, rotate))
+
+        if size == "large" and Config.photo.exif_rotation:
+            outfile = rotate_exif(fname, rotate)
+            if outfile is not None:
+                sizes[size] = outfile
+                continue
+
+        img = open_photo(fname).transpose(ROTATIONS[rotate])
+        sizes[size] = save_photo(img, photo_filetype(fname))
+
+    # The variants are always saved upright, so just turn them around too.
+    sizes["variants"] = dict()
+    for size, variants in photo.get("variants", {}).items():
+        sizes["variants"][size] = list()
+        for filetype, width, name in variants:
+            if name == photo[size]:
+                # The size itself, which was rotated above.
+                outfile = sizes[size]
+            else:
+                fname = os.path.join(Config.photo.root_private, name)
+                img = Image.open(fname).transpose(ROTATIONS[rotate])
+                outfile = save_photo(img, filetype)
+            sizes["variants"][size].append([filetype, image_size(outfile)[0],
+                outfile])
+
+    return sizes
+
 
-        # Give it a new name.
-        filetype = fname.split(".")[-1]
-        outfile = random_name(filetype)
-        new_names[size] = outfile
+def rotate_exif(filename, rotate):
+    """Rotate a JPEG by changing its EXIF orientation.
 
-        img = Image.open(fname)
-        img = img.rotate(degrees)
-        img.save(os.path.join(Config.photo.root_private, outfile))
+    The new copy of the file has the same image data, byte for byte. Returns
+    its file name, or None if the photo has no EXIF data to change."""
+    img = Image.open(filename)
+    if img.format != "JPEG" or not "exif" in img.info:
+        return None
 
-        # Delete the old name.
-        os.unlink(fname)
+    exif = img.getexif()
+    exif[EXIF_ORIENTATION] = EXIF_ROTATIONS[rotate][get_orientation(img)]
+
+    with open(filename, "rb") as fh:
+        data = replace_exif(fh.read(), exif.tobytes())
+    if data is None:
+        return None
 
-    # Save the new image names.
-    edit_photo(key, new_names)
+    return store_photo(data, "jpg")
+
+
+def replace_exif(data, exif):
+    """Swap out the EXIF segment in the raw bytes of a JPEG file.
+
+    Returns the new bytes of the file, or None if it has no EXIF segment (or
+    the new one doesn't fit)."""
+    if len(exif) + 2 > 0xFFFF:
+        return None
+
+    # Walk the segments up to the start of the image data.
+    i = 2
+    while data[i:i+1] == b"\xff":
+        marker = data[i+1:i+2]
+        if marker == b"\xda":
+            break
+
+        length = struct.unpack(">H", data[i+2:i+4])[0]
+        if marker == b"\xe1" and data[i+4:i+10] == b"Exif\x00\x00":
+            segment = b"\xff\xe1" + struct.pack(">H", len(exif) + 2) + exif
+            return data[:i] + segment + data[i+2+length:]
+        i += 2 + length
+
+    return None
 
 
 def delete_photo(key):
     """Delete a photo."""
-    index = get_index()
-    if not key in index["map"]:
+    with albums_locked():
+        _delete_photo(key)
+
+
+def _delete_photo(key):
+    """The guts of delete_photo()."""
+    photo_map = get_map()
+    if not key in photo_map:
         logger.warning("Tried to delete photo {} but it wasn't found?".format(key))
         return
 
-    album = index["map"][key]
+    album = photo_map[key]
+    shard = get_shard(album)
 
     logger.info("Completely deleting the photo {} from album {}".format(key, album))
-    photo = index["albums"][album][key]
+    photo = shard["photos"][key]
 
-    # Delete all the images.
-    for size in ["large", "thumb", "avatar"]:
-        logger.info("Delete: {}".format(photo[size]))
-        fname = os.path.join(Config.photo.root_private, photo[size])
-        if os.path.isfile(fname):
-            os.unlink(fname)
+    # Delete all the images (unless other photos share them).
+    release_files(photo_files(photo))
 
     # Delete it from the sort list.
-    index["photo-order"][album].remove(key)
-    del index["map"][key]
-    del index["albums"][album][key]
-
-    # Was this the album cover?
-    if index["covers"][album] == key:
-        # Try to pick a new one.
-        if len(index["photo-order"][album]) > 0:
-            index["covers"][album] = index["photo-order"][album][0]
-        else:
-            index["covers"][album] = ""
+    shard["order"].remove(key)
+    del shard["photos"][key]
+    del photo_map[key]
+    write_map(photo_map)
+
+    catalog = get_catalog()
+    settings = catalog["albums"][album]
+
+    if len(shard["order"]) == 0:
+        # If the album is empty now too, delete it as well.
+        JsonDB.delete(shard_document(album))
+        del catalog["albums"][album]
+        catalog["album-order"].remove(album)
+        write_catalog(catalog)
+    else:
+        write_shard(album, shard)
 
-    # If the album is empty now too, delete it as well.
-    if len(index["albums"][album].keys()) == 0:
-        del index["albums"][album]
-        del index["photo-order"][album]
-        del index["covers"][album]
-        index["album-order"].remove(album)
+        # Was this the album cover? Pick a new one.
+        if settings["cover"] == key:
+            settings["cover"] = shard["order"][0]
+            settings["cover-thumb"] = shard["photos"][settings["cover"]]["thumb"]
+            write_catalog(catalog)
 
-    write_index(index)
+    JsonDB.invalidate_tags("album:{}".format(album), "avatars")
 
 
 def order_albums(order):
     """Reorder the albums according to the new order list."""
-    index = get_index()
-
-    # Sanity check, make sure all albums are included.
-    if len(order) != len(index["album-order"]):
-        logger.warning("Can't reorganize albums because the order lists don't match!")
-        return None
+    with albums_locked():
+        catalog = get_catalog()
 
-    for album in index["album-order"]:
-        if album not in order:
-            logger.warning("Tried reorganizing albums, but {} was missing!".format(album))
+        # Sanity check, make sure all albums are included.
+        if len(order) != len(catalog["album-order"]):
+            logger.warning("Can't reorganize albums because the order lists don't match!")
             return None
 
-    index["album-order"] = order
-    write_index(index)
+        for album in catalog["album-order"]:
+            if album not in order:
+                logger.warning("Tried reorganizing albums, but {} was missing!".format(album))
+                return None
+
+        catalog["album-order"] = order
+        write_catalog(catalog)
 
 
 def order_photos(album, order):
     """Reorder the photos according to the new order list."""
-    index = get_index()
-
-    if not album in index["albums"]:
-        logger.warning("Album not found: {}".format(album))
-        return None
+    with albums_locked():
+        shard = get_shard(album)
 
-    # Sanity check, make sure all albums are included.
-    if len(order) != len(index["photo-order"][album]):
-        logger.warning("Can't reorganize photos because the order lists don't match!")
-        return None
+        if shard is None:
+            logger.warning("Album not found: {}".format(album))
+            return None
 
-    for key in index["photo-order"][album]:
-        if key not in order:
-            logger.warning("Tried reorganizing photos, but {} was missing!".format(key))
+        # Sanity check, make sure all albums are included.
+        if len(order) != len(shard["order"]):
+            logger.warning("Can't reorganize photos because the order lists don't match!")
             return None
 
-    index["photo-order"][album] = order
-    write_index(index)
+        for key in shard["order"]:
+            if key not in order:
+                logger.warning("Tried reorganizing photos, but {} was missing!".format(key))
+                return None
+
+        shard["order"] = order
+        write_shard(album, shard)
+        JsonDB.invalidate_tags("album:{}".format(album))
 
 
 def upload_from_pc(request):
@@ -417,28 +562,37 @@ def upload_from_pc(request):
     * photo: if successful
     """
 
-    form   = request.form
-    count  = 0
-    status = None
+    form      = request.form
+    tempfiles = list()
     for upload in reversed(request.files.getlist("file")):
-        count += 1
-
         # Make a temp filename for it.
         filetype = upload.filename.rsplit(".", 1)[-1]
         if not allowed_filetype(upload.filename):
+            for tempfile in tempfiles:
+                os.unlink(tempfile)
             return dict(success=False, error="Unsupported file extension.")
 
-        tempfile = "{}/rophako-photo-{}.{}".format(Config.site.tempdir, int(time.time()), filetype)
+        tempfile = temp_name(filetype)
         logger.debug("Save incoming photo to: {}".format(tempfile))
-        upload.save(tempfile)
+        if hasattr(upload.stream, "claim"):
+            # It was spooled to disk already; just move it.
+            upload.stream.claim(tempfile)
+        else:
+            upload.save(tempfile, buffer_size=CHUNK_SIZE)
+        tempfiles.append(tempfile)
 
-        # All good so far. Process the photo.
-        status = process_photo(form, tempfile)
-        if not status["success"]:
-            return status
+        # Make sure it's really a photo we can handle.
+        error = check_photo(tempfile)
+        if error:
+            for tempfile in tempfiles:
+                os.unlink(tempfile)
+            return dict(success=False, error=error)
+
+    # All good so far. Process the photos.
+    status = process_photos(form, tempfiles)
 
     # Multi upload?
-    if count > 1:
+    if len(tempfiles) > 1:
         status["multi"] = True
     else:
         status["multi"] = False
@@ -461,33 +615,290 @@ def upload_from_www(form):
 
     # Make a temp filename for it.
     filetype = url.rsplit(".", 1)[1]
-    tempfile = "{}/rophako-photo-{}.{}".format(Config.site.tempdir, int(time.time()), filetype)
+    tempfile = temp_name(filetype)
     logger.debug("Save incoming photo to: {}".format(tempfile))
 
     # Grab the file.
+    error = download_photo(url, tempfile)
+    if not error:
+        error = check_photo(tempfile)
+    if error:
+        if os.path.isfile(tempfile):
+            os.unlink(tempfile)
+        return dict(success=False, error=error)
+
+    # All good so far. Process the photo.
+    return process_photos(form, [tempfile])
+
+
+def download_photo(url, filename):
+    """Download a photo from the web into a file, a chunk at a time.
+
+    The download is cut off if it goes past `photo.max_upload_size` or takes
+    longer than `photo.fetch_timeout` seconds. Returns an error message, or
+    None if it was successful."""
+    limit   = int(Config.photo.max_upload_size)
+    timeout = int(Config.photo.fetch_timeout)
+    started = time.time()
+
     try:
-        data = requests.get(url).content
-    except:
-        return dict(success=False, error="Failed to get that URL.")
+        resp = requests.get(url, stream=True, timeout=timeout)
+    except Exception as e:
+        logger.error("Failed to get photo URL {}: {}".format(url, e))
+        return "Failed to get that URL."
 
-    fh = open(tempfile, "wb")
-    fh.write(data)
-    fh.close()
+    try:
+        if resp.status_code != 200:
+            return "Failed to get that URL (HTTP {}).".format(resp.status_code)
+
+        # Don't even start if it says it's too big.
+        length = resp.headers.get("Content-Length", "")
+        if limit and length.isdigit() and int(length) > limit:
+            return too_big(limit)
+
+        size = 0
+        with open(filename, "wb") as fh:
+            for chunk in resp.iter_content(CHUNK_SIZE):
+                size += len(chunk)
+                if limit and size > limit:
+                    return too_big(limit)
+                if time.time() - started > timeout:
+                    return "Downloading that URL took too long."
+                fh.write(chunk)
+    except Exception as e:
+        logger.error("Failed to download photo URL {}: {}".format(url, e))
+        return "Failed to get that URL."
+    finally:
+        resp.close()
+
+    return None
+
+
+def check_photo(filename):
+    """Check that an incoming photo is an image that we can handle, and isn't
+    too big, before anything decodes it. Only the image header is read.
+
+    Returns an error message, or None if it looks good."""
+    limit = int(Config.photo.max_upload_size)
+    if limit and os.path.getsize(filename) > limit:
+        return too_big(limit)
 
-    # All good so far. Process the photo.
-    return process_photo(form, tempfile)
+    try:
+        img = Image.open(filename)
+    except Exception as e:
+        logger.error("Incoming photo {} isn't an image: {}".format(filename, e))
+        return "That file isn't an image."
 
+    if not img.format in PHOTO_FORMATS:
+        return "Unsupported image type: {}.".format(img.format)
 
-def process_photo(form, filename):
-    """Formats an incoming photo."""
+    width, height = img.size
+    max_pixels = int(Config.photo.max_pixels)
+    if max_pixels and width * height > max_pixels:
+        return "The photo is too big ({}x{}; the limit is {:.1f} megapixels).".format(
+            width, height, max_pixels / 1000000.0,
+        )
 
-    # Resize the photo to each of the various sizes and collect their names.
-    sizes = dict()
-    for size in PHOTO_SCALES.keys():
-        sizes[size] = resize_photo(filename, size)
+    return None
+
+
+def too_big(limit):
+    """The error message for a photo file that's over the size limit."""
+    return "The photo is too big (the limit is {:.1f} MB).".format(
+        limit / 1024.0 / 1024.0,
+    )
+
+
+def process_photos(form, filenames):
+    """Formats incoming photos.
+
+    A photo that was uploaded before (with the same file contents) reuses the
+    sizes that were made for it then. The others are added to their album
+    right away, marked as `processing`, and their sizes are made in the
+    background. The temp files are deleted when that's done.
+
+    Returns the same structure as `upload_from_pc()`, for the last photo."""
+    status = None
+    photos = list()
+    for filename in filenames:
+        digest = file_digest(filename)
+        sizes = find_source(digest)
+        if sizes is not None:
+            logger.info("Photo {} was uploaded before; reusing its sizes.".format(digest))
+            os.unlink(filename)
+            sizes["dimensions"] = measure_photo(sizes)
+            status = add_photo(form, sizes)
+            continue
+
+        status = add_photo(form, dict(
+            large="",
+            thumb="",
+            avatar="",
+            processing=int(time.time()),
+            upload=[filename, digest],
+        ))
+        photos.append([status["photo"], filename, digest])
+
+    if len(photos):
+        Jobs.enqueue("photo.resize", photos=photos)
+    return status
 
-    # Remove the temp file.
-    os.unlink(filename)
+
+@Jobs.task("photo.resize")
+def resize_photos(photos):
+    """Job that makes the sizes of new photos for process_photos().
+
+    `photos` is a list of [key, temp file name, hash of the file] lists."""
+
+    # Resize all the photos (at the same time, if we have the workers for it).
+    # A photo whose temp file is gone was already done by another job (see
+    # recover_photos()).
+    photos = [ photo for photo in photos if os.path.isfile(photo[1]) ]
+    filenames = [ photo[1] for photo in photos ]
+    for photo, sizes in zip(photos, make_sizes_many(filenames)):
+        key, digest = photo[0], photo[2]
+        try:
+            if sizes is None:
+                # Couldn't read the photo; get rid of it.
+                logger.error("Removing photo {}: the upload couldn't be resized.".format(key))
+                delete_photo(key)
+                continue
+
+            finish_photo(key, sizes, digest)
+        except Exception as e:
+            # Don't take the rest of the batch down with it; recover_photos()
+            # will clean this one up.
+            logger.exception("Couldn't save the sizes of photo {}: {}".format(key, e))
+
+
+@Jobs.task("photo.recover", startup=True)
+def recover_photos():
+    """Job that picks up after the photos left `processing` by lost jobs (e.g.
+    when the server was restarted in the middle of one).
+
+    A photo counts as lost once it's been processing for longer than
+    `photo.processing_timeout`. A new upload is resized again if its temp file
+    is still around, and deleted if it isn't. A photo that was being cropped
+    or rotated just keeps the files it had."""
+    timeout = int(Config.photo.processing_timeout)
+    now = int(time.time())
+    resize, lost, albums = list(), list(), set()
+
+    with albums_locked():
+        for album in get_catalog()["album-order"]:
+            shard = get_shard(album)
+            for key in shard["order"]:
+                photo = shard["photos"][key]
+                if not photo.get("processing") \
+                    or now - int(photo["processing"]) < timeout:
+                    continue
+
+                albums.add(album)
+                if photo.get("large"):
+                    logger.warning("Photo {} was left processing; it keeps its old files.".format(key))
+                    photo.pop("processing")
+                elif photo.get("upload") and os.path.isfile(photo["upload"][0]):
+                    logger.warning("Photo {} was left processing; resizing it again.".format(key))
+                    photo["processing"] = now
+                    resize.append([key] + photo["upload"])
+                else:
+                    logger.error("Removing photo {}: its upload was lost while it was being processed.".format(key))
+                    lost.append(key)
+
+            if album in albums:
+                write_shard(album, shard)
+
+        for key in lost:
+            _delete_photo(key)
+
+    if len(albums):
+        JsonDB.invalidate_tags(*[ "album:{}".format(album) for album in albums ])
+    if len(resize):
+        Jobs.enqueue("photo.resize", photos=resize)
+
+
+def finish_photo(key, sizes, digest=None):
+    """Save the new files of a photo that was `processing`, and clear its
+    `processing` state.
+
+    The files that the new ones replace are deleted (files that the photo
+    keeps are left alone). If the photo has been deleted in the meantime, the
+    new files are deleted instead. For a new upload, `digest` is the hash of
+    the uploaded file, to remember its sizes by (see find_source())."""
+    new_files = photo_files(sizes)
+    dimensions = measure_photo(sizes)
+
+    with albums_locked():
+        # The album is looked up under the lock: it may have been renamed, or
+        # the photo moved, while the job ran.
+        album = get_map().get(key)
+        hashes = get_hashes()
+
+        shard = get_shard(album) if album else None
+        if shard is None or not key in shard["photos"]:
+            logger.warning("Photo {} was deleted while it was being processed.".format(key))
+            add_refs(hashes, new_files)
+            release_refs(hashes, new_files)
+            write_hashes(hashes)
+            return
+
+        # The new sizes replace the old ones along with their variants.
+        photo = shard["photos"][key]
+        old_files = photo_files(photo, [ size for size in sizes
+            if size != "variants" ])
+        add_refs(hashes, [ name for name in new_files if not name in old_files ])
+        replaced = [ name for name in old_files if not name in new_files ]
+        variants = photo.get("variants", {})
+        for size in sizes:
+            if size == "variants":
+                continue
+            photo[size] = sizes[size]
+            variants.pop(size, None)
+            if size in sizes.get("variants", {}):
+                variants[size] = sizes["variants"][size]
+        photo.pop("variants", None)
+        if len(variants):
+            photo["variants"] = variants
+        photo.setdefault("dimensions", dict()).update(dimensions)
+        photo.pop("processing", None)
+        photo.pop("upload", None)
+
+        if digest is not None:
+            set_source(hashes, digest, sizes)
+        release_refs(hashes, replaced)
+        write_hashes(hashes)
+
+        write_shard(album, shard)
+        update_cover_thumb(album, key, photo["thumb"])
+
+    # The avatar may be somebody's profile picture.
+    JsonDB.invalidate_tags("album:{}".format(album), "avatars")
+
+
+@contextmanager
+def albums_locked():
+    """Context manager to add photos or save the results of a job, one thread
+    at a time (per site, if Redis is available), so that they don't overwrite
+    each other's changes to the album documents."""
+    with ALBUMS_LOCK:
+        lock = JsonDB.lock_cache("photos/lock")
+        try:
+            yield
+        finally:
+            JsonDB.unlock_cache(lock)
+
+
+def add_photo(form, sizes):
+    """Add a new photo to its album.
+
+    `sizes` is the photo data for the sizes of the photo (see make_sizes()).
+    """
+    with albums_locked():
+        return _add_photo(form, sizes)
+
+
+def _add_photo(form, sizes):
+    """The guts of add_photo()."""
 
     # What album are the photos going to?
     album     = form.get("album", "")
@@ -508,21 +919,17 @@ def process_photo(form, filename):
         key = random_hash()
     logger.debug("Photo set public key: {}".format(key))
 
-    # Get the album index to manipulate ordering.
-    index = get_index()
+    # Get the album's catalog entry and its photos.
+    catalog = get_catalog()
+    shard = get_shard(album) or dict(name=album, photos={}, order=[])
 
-    # Update the photo data.
-    if not album in index["albums"]:
-        index["albums"][album] = {}
-    if not "settings" in index:
-        index["settings"] = dict()
-    if not album in index["settings"]:
-        index["settings"][album] = {
-            "format": "classic",
-            "description": new_desc,
-        }
+    # Count the photo's files as in use.
+    hashes = get_hashes()
+    add_refs(hashes, photo_files(sizes))
+    write_hashes(hashes)
 
-    index["albums"][album][key] = dict(
+    # Update the photo data.
+    shard["photos"][key] = dict(
         ip=remote_addr(),
         author=g.info["session"]["uid"],
         uploaded=int(time.time()),
@@ -531,24 +938,28 @@ def process_photo(form, filename):
         **sizes
     )
 
-    # Maintain a photo map to album.
-    index["map"][key] = album
-
     # Add this pic to the front of the album.
-    if not album in index["photo-order"]:
-        index["photo-order"][album] = []
-    index["photo-order"][album].insert(0, key)
-
-    # If this is a new album, add it to the front of the album ordering.
-    if not album in index["album-order"]:
-        index["album-order"].insert(0, album)
+    shard["order"].insert(0, key)
+    write_shard(album, shard)
 
-    # Set the album cover for a new album.
-    if not album in index["covers"] or len(index["covers"][album]) == 0:
-        index["covers"][album] = key
+    # Maintain a photo map to album.
+    photo_map = get_map()
+    photo_map[key] = album
+    write_map(photo_map)
+
+    # If this is a new album, add it to the front of the album ordering, and
+    # set its album cover.
+    if not album in catalog["albums"]:
+        catalog["album-order"].insert(0, album)
+        catalog["albums"][album] = {
+            "format": "classic",
+            "description": new_desc or "",
+            "cover": key,
+            "cover-thumb": sizes["thumb"],
+        }
+        write_catalog(catalog)
 
-    # Save changes to the index.
-    write_index(index)
+    JsonDB.invalidate_tags("album:{}".format(album))
 
     return dict(success=True, photo=key)
 
@@ -559,23 +970,377 @@ def allowed_filetype(filename):
         filename.rsplit(".", 1)[1].lower() in ['jpeg', 'jpe', 'jpg', 'gif', 'png']
 
 
-def resize_photo(filename, size, crop=None):
-    """Resize a photo from the target filename into the requested size.
+def make_sizes(filename):
+    """Make the large, thumb and avatar versions of a new photo.
 
-    Optionally the photo can be cropped with custom parameters.
-    """
+    The source file is only decoded once: the large version is scaled down
+    from it, and the thumb and avatar are cut from the large version (see
+    make_squares()).
 
-    # Find the file type.
-    filetype = filename.rsplit(".", 1)[1]
-    if filetype == "jpeg": filetype = "jpg"
+    Returns a dict of size names to the new file names."""
+    filetype = photo_filetype(filename)
+    img = Image.open(filename)
+
+    # For JPEGs, let the decoder skip straight to the smallest 1/2, 1/4 or
+    # 1/8 scale that's still bigger than the large size.
+    if img.format == "JPEG":
+        width, height = img.size
+        new_width = PHOTO_SCALES["large"]
+        if width > new_width:
+            img.draft(img.mode, (new_width, int(height * new_width / width)))
+    img.load()
+
+    # With EXIF rotation, the large size keeps the photo's orientation, so
+    # rotate_photo() only has to change that.
+    orientation = None
+    if Config.photo.exif_rotation and img.format == "JPEG":
+        orientation = get_orientation(img)
+
+    large = scale_photo(img, "large")
+    turned = upright(large, orientation)
+    sizes = make_squares(turned, filetype)
+    sizes["large"] = save_photo(large, filetype, orientation)
+    add_variants(sizes, "large", turned)
+
+    return sizes
+
+
+def regenerate_sizes(photo):
+    """Make the sizes of a photo again from its current files, for when the
+    size settings have changed (see scripts/photos.py).
+
+    The large size is scaled down again if it's wider than the large width
+    now. The thumb is scaled from the current thumb, which keeps its crop,
+    unless that's smaller than the thumb width now; then it's cut from the
+    large size again (and loses its custom crop). The avatar and variants are
+    made again from those. Sizes that don't change keep their file.
+
+    Returns a dict of size names to file names (see finish_photo())."""
+    source = os.path.join(Config.photo.root_private, photo["large"])
+    filetype = photo_filetype(source)
+    img = Image.open(source)
+
+    # Keep the large size's EXIF orientation, if it has one.
+    orientation = None
+    if img.format == "JPEG" and "exif" in img.info:
+        orientation = get_orientation(img)
+
+    sizes = dict(large=photo["large"])
+    large = scale_photo(img, "large")
+    if large is not img:
+        sizes["large"] = save_photo(large, filetype, orientation)
+    turned = upright(large, orientation)
+
+    sizes["thumb"] = photo["thumb"]
+    old_thumb = Image.open(os.path.join(Config.photo.root_private, photo["thumb"]))
+    if old_thumb.size[0] >= PHOTO_SCALES["thumb"]:
+        thumb = scale_photo(old_thumb, "thumb")
+    else:
+        logger.warning("The thumb of {} is too small; cutting a new one.".format(photo["large"]))
+        thumb = scale_photo(turned, "thumb")
+    if thumb is not old_thumb:
+        sizes["thumb"] = save_photo(thumb, filetype)
+
+    sizes["avatar"] = save_photo(scale_photo(thumb, "avatar"), filetype)
+    add_variants(sizes, "large", turned)
+    add_variants(sizes, "thumb", thumb)
+    return sizes
+
+
+def measure_photo(photo):
+    """Get the dimensions and file sizes of a photo's files (or of a dict of
+    sizes), as they're kept in the photo's `dimensions`.
 
-    # Open the image.
+    Returns a dict of size names to dicts of their `width`, `height` and
+    `bytes`."""
+    dimensions = dict()
+    for size in ["large", "thumb", "avatar"]:
+        if not photo.get(size):
+            continue
+        width, height = image_size(photo[size])
+        dimensions[size] = dict(
+            width=width,
+            height=height,
+            bytes=os.path.getsize(os.path.join(Config.photo.root_private, photo[size])),
+        )
+    return dimensions
+
+
+def backfill_dimensions():
+    """Record the dimensions of the photos from before they were kept (see
+    measure_photo()), in the background."""
+    Jobs.enqueue("photo.dimensions")
+
+
+@Jobs.task("photo.dimensions")
+def record_dimensions():
+    """Job that records the dimensions of the photos that don't have them.
+
+    Returns the number of photos that were updated."""
+    count = 0
+    for album in list_albums():
+        with albums_locked():
+            shard = get_shard(album["name"])
+            if not shard:
+                continue
+
+            changed = False
+            for key, photo in shard["photos"].items():
+                if photo.get("dimensions") or photo.get("processing") \
+                    or not photo.get("large"):
+                    continue
+
+                try:
+                    photo["dimensions"] = measure_photo(photo)
+                    changed = True
+                    count += 1
+                except Exception as e:
+                    logger.error("Couldn't measure photo {}: {}".format(key, e))
+
+            if changed:
+                write_shard(album["name"], shard)
+        if changed:
+            JsonDB.invalidate_tags("album:{}".format(album["name"]))
+
+    logger.info("Recorded the dimensions of {} photos.".format(count))
+    return count
+
+
+def make_squares(large, filetype, crop=None):
+    """Make the thumb and avatar sizes from the large size of a photo (as a
+    PIL image), optionally with custom crop parameters. The avatar is scaled
+    down from the thumb, which is the same square of the photo but a lot less
+    work to resize.
+
+    Returns a dict of their new file names (and their variants)."""
+    thumb = scale_photo(large, "thumb", crop)
+    avatar = scale_photo(thumb, "avatar")
+    sizes = dict(
+        thumb=save_photo(thumb, filetype),
+        avatar=save_photo(avatar, filetype),
+    )
+    add_variants(sizes, "thumb", thumb)
+    return sizes
+
+
+def add_variants(sizes, size, img):
+    """Make the variants of a photo size (see make_variants()) that was saved
+    in a dict of sizes, and add them to it under `variants`."""
+    variants = make_variants(img, size, sizes[size])
+    sizes.setdefault("variants", dict())
+    if len(variants):
+        sizes["variants"][size] = variants
+
+
+def make_variants(img, size, name):
+    """Make the responsive versions of a photo size from its PIL image and
+    the name it was saved under: the size itself in each of the extra
+    `photo.variant_formats`, and each of its smaller `photo.variant_widths`
+    in every format.
+
+    Returns a list of [file type, width, file name] for each, widest first.
+    The size itself is the first, so that all its versions are listed (or the
+    list is empty if it has no others)."""
+    variants = list()
+    if not size in VARIANT_SIZES:
+        return variants
+
+    filetype = photo_filetype(name).lower()
+    formats = [filetype] + [ f for f in variant_formats() if f != filetype ]
+    width, height = img.size
+    widths = sorted([ int(w) for w in Config.photo.variant_widths.get(size) or []
+        if int(w) < width ], reverse=True)
+
+    for new_width in [width] + widths:
+        scaled = img
+        if new_width != width:
+            new_height = max(1, int(float(height) * new_width / width))
+            scaled = resample(img, size, (new_width, new_height))
+
+        for fmt in formats:
+            if new_width == width and fmt == filetype:
+                # That's the photo size itself.
+                continue
+
+            out = scaled
+            if fmt != filetype and not out.mode in ("RGB", "RGBA"):
+                transparent = out.mode in ("LA", "PA") or "transparency" in out.info
+                out = out.convert("RGBA" if transparent else "RGB")
+            variants.append([fmt, new_width, save_photo(out, fmt)])
+
+    if len(variants):
+        variants.insert(0, [filetype, width, name])
+    return variants
+
+
+def variant_formats():
+    """Get the `photo.variant_formats` that this copy of PIL can save."""
+    global VARIANT_FORMATS
+    if VARIANT_FORMATS is None:
+        VARIANT_FORMATS = list()
+        for fmt in Config.photo.variant_formats or []:
+            fmt = fmt.lower()
+            if Image.registered_extensions().get("." + fmt) in Image.SAVE:
+                VARIANT_FORMATS.append(fmt)
+            else:
+                logger.warning("Can't make {} photos: PIL doesn't support it.".format(fmt))
+    return VARIANT_FORMATS
+
+
+def get_sources(photo):
+    """Get the responsive versions of a photo's sizes, for showing it with a
+    <picture> (see photos/picture.inc.html).
+
+    Returns a dict of size names to a list of the photo's <source>s, each a
+    dict of its `type`, `srcset` and `sizes`. The extra formats come first,
+    and the photo's own format last. Sizes without variants aren't in it."""
+    sources = dict()
+    for size, variants in photo.get("variants", {}).items():
+        if not photo.get(size):
+            continue
+        filetype = photo_filetype(photo[size]).lower()
+
+        # Gather the files of each format, keeping the order they're in, but
+        # with the photo's own format last.
+        formats = list()
+        files = dict()
+        for fmt, w, name in variants:
+            if not fmt in files:
+                formats.append(fmt)
+                files[fmt] = list()
+            files[fmt].append([w, name])
+        if filetype in formats:
+            formats.remove(filetype)
+            formats.append(filetype)
+
+        sources[size] = [ dict(
+            type=Image.MIME.get(Image.registered_extensions().get("." + fmt)),
+            srcset=", ".join([ "{}/{} {}w".format(Config.photo.root_public,
+                name, w) for w, name in files[fmt] ]),
+            sizes=Config.photo.variant_sizes.get(size, ""),
+        ) for fmt in formats ]
+
+    return sources
+
+
+def make_sizes_many(filenames):
+    """Run make_sizes() on several photos, and delete the source files.
+
+    With `photo.workers` set, the photos are processed in parallel in a pool
+    of worker processes.
+
+    Returns the sizes of each photo, in order, or None for photos that
+    couldn't be resized."""
+    if int(Config.photo.workers) > 1 and len(filenames) > 1:
+        results = get_pool().map(try_make_sizes, filenames)
+    else:
+        results = [ try_make_sizes(filename) for filename in filenames ]
+
+    # Remove the temp files.
+    for filename in filenames:
+        os.unlink(filename)
+
+    return results
+
+
+def try_make_sizes(filename):
+    """Run make_sizes(), logging the error and returning None if it fails."""
+    try:
+        return make_sizes(filename)
+    except Exception as e:
+        logger.error("Couldn't resize photo {}: {}".format(filename, e))
+        return None
+
+
+def get_pool():
+    """Get the pool of processes for resizing photos, starting it the first
+    time it's needed.
+
+    The pool is started from the job thread of a web server that has other
+    threads running, so the workers are spawned fresh instead of forked (a
+    forked child could inherit a lock that another thread was holding, and
+    wait on it forever). They're given our settings to start with."""
+    global POOL
+    if POOL is None:
+        context = multiprocessing
+        if hasattr(multiprocessing, "get_context"):
+            context = multiprocessing.get_context("spawn")
+        POOL = context.Pool(int(Config.photo.workers),
+            initializer=init_worker, initargs=(Config.settings,))
+        atexit.register(POOL.terminate)
+    return POOL
+
+
+def get_resized(key, width, height):
+    """Get a copy of a photo's large size scaled down to fit in the box of
+    `width` by `height` pixels (0 for either means no limit on that side),
+    making it if it hasn't been made before.
+
+    Only the sizes listed in `photo.img_sizes` can be made. The copies are
+    kept in `photo.img_cache`, named after the large size's file (so they're
+    made again when that changes).
+
+    Returns the copy's file name in the cache, or None if the photo doesn't
+    exist (or isn't ready) or the size isn't allowed."""
+    size = "{}x{}".format(width, height)
+    if not size in [ str(allowed) for allowed in Config.photo.img_sizes or [] ]:
+        return None
+
+    photo = get_photo(key)
+    if not photo or not photo.get("large"):
+        return None
+
+    name, filetype = photo["large"].rsplit(".", 1)
+    outfile = "{}.{}.{}".format(name, size, filetype)
+    target  = os.path.join(Config.photo.img_cache, outfile)
+    if os.path.isfile(target):
+        return outfile
+
+    # Fit the photo into the box.
+    img = open_photo(os.path.join(Config.photo.root_private, photo["large"]))
+    orig_width, orig_height = img.size
+    ratio = min([ float(limit) / orig for limit, orig in
+        [[width, orig_width], [height, orig_height]] if limit > 0 ] + [1.0])
+    if ratio < 1.0:
+        new_size = (max(1, int(orig_width * ratio)), max(1, int(orig_height * ratio)))
+        logger.debug("Resize photo {} to {}x{}".format(key, *new_size))
+        img = resample(img, "large", new_size)
+
+    buf = io.BytesIO()
+    img.save(buf, Image.registered_extensions()["." + filetype.lower()])
+    write_file(target, buf.getvalue())
+    return outfile
+
+
+def open_photo(filename):
+    """Open a photo with PIL, turned upright if it has an EXIF orientation."""
     img = Image.open(filename)
+    return upright(img, get_orientation(img))
 
-    # Make up a unique filename.
-    outfile = random_name(filetype)
-    target  = os.path.join(Config.photo.root_private, outfile)
-    logger.debug("Output file for {} scale: {}".format(size, target))
+
+def get_orientation(img):
+    """Get the EXIF orientation of a PIL image (1 if it doesn't have one)."""
+    orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+    if not orientation in EXIF_ROTATIONS["180"]:
+        orientation = 1
+    return orientation
+
+
+def upright(img, orientation):
+    """Turn a PIL image upright for its EXIF orientation."""
+    if orientation in ORIENTATION_TRANSPOSE:
+        return img.transpose(ORIENTATION_TRANSPOSE[orientation])
+    return img
+
+
+def scale_photo(img, size, crop=None):
+    """Scale a PIL image down to the requested size.
+
+    The large size is only scaled; the other sizes are cropped into a square
+    (optionally with custom crop parameters) and scaled.
+
+    Returns the new image, or the same image if it was already that size.
+    """
 
     # Get the image's dimensions.
     orig_width, orig_height = img.size
@@ -587,20 +1352,16 @@ def resize_photo(filename, size, crop=None):
         # Do we NEED to scale it?
         if orig_width <= new_width:
             logger.debug("Don't need to scale down the large image!")
-            img.save(target)
-            return outfile
+            return img
 
         # Scale it down.
         ratio      = float(new_width) / float(orig_width)
         new_height = int(float(orig_height) * float(ratio))
         logger.debug("New image dimensions: {}x{}".format(new_width, new_height))
-        img = img.resize((new_width, new_height), Image.ANTIALIAS)
-        img.save(target)
-        return outfile
+        return resample(img, size, (new_width, new_height))
 
     # For all other versions, crop them into a square.
     x, y, length = 0, 0, 0
-
     # Use 0,0 and find the shortest dimension for the length.
     if orig_width > orig_height:
         length = orig_height
@@ -643,45 +1404,484 @@ def resize_photo(filename, size, crop=None):
     # Do we need to scale?
     if new_width == length:
         logger.debug("Image doesn't need to be cropped or scaled!")
-        img.save(target)
-        return outfile
+        return img
 
     # Crop to the requested box.
     logger.debug("Cropping the photo")
     img = img.crop((x, y, x+length, y+length))
 
     # Scale it to the proper dimensions.
-    img = img.resize((new_width, new_width), Image.ANTIALIAS)
-    img.save(target)
+    return resample(img, size, (new_width, new_width))
+
+
+def resample(img, size, dimensions):
+    """Resize a PIL image to new dimensions, using the filter for the photo
+    size that it's being made into."""
+
+    # Palette images can only be resized with the nearest neighbor, which is
+    # fast and keeps their files small, and looks fine until it starts
+    # skipping most of the pixels. Past that, give them real colors for the
+    # filter, and map them back onto the same palette after (which is much
+    # faster than working out a new palette when saving). Transparent ones
+    # can't be mapped back, so they stay with the nearest neighbor.
+    palette = None
+    if img.mode == "P" and not "transparency" in img.info \
+        and img.size[0] > dimensions[0] * REDUCING_GAP:
+        palette = img
+        img = img.convert("RGB")
+
+    img = img.resize(dimensions, PHOTO_FILTERS[size],
+        reducing_gap=REDUCING_GAP)
+    if palette is not None:
+        img = img.quantize(palette=palette)
+    return img
+
+
+def save_photo(img, filetype, orientation=None):
+    """Save a PIL image into the photo folder (see store_photo()).
+
+    Optionally, give it an EXIF orientation (for JPEGs).
+
+    Returns the new file name."""
+    params = dict()
+    if orientation is not None:
+        exif = Image.Exif()
+        exif[EXIF_ORIENTATION] = orientation
+        params["exif"] = exif.tobytes()
+
+    buf = io.BytesIO()
+    img.save(buf, Image.registered_extensions()["." + filetype.lower()],
+        **params)
+    return store_photo(buf.getvalue(), filetype)
+
+
+def store_photo(data, filetype):
+    """Store an image file in the photo folder, named for the hash of its
+    contents and sorted into folders by the start of the hash:
+    `ab/cd/abcdef0123(...).jpg`.
+
+    Identical files end up with the same name, so if the file is there
+    already it isn't written again.
+
+    Returns the file name (relative to the photo folder)."""
+    digest  = hashlib.sha256(data).hexdigest()
+    outfile = "/".join([ digest[0:2], digest[2:4],
+        "{}.{}".format(digest, filetype.lower()) ])
+    target  = os.path.join(Config.photo.root_private, outfile)
+    if os.path.isfile(target):
+        # Touch it, so it isn't deleted if it was released just now (see
+        # release_refs()) before the photo using it again counts it.
+        logger.debug("Photo already exists: {}".format(target))
+        try:
+            os.utime(target, None)
+            return outfile
+        except OSError:
+            pass # Deleted just now; write it again.
+
+    logger.debug("Save photo: {}".format(target))
+    write_file(target, data)
     return outfile
 
 
-def get_index():
-    """Get the photo album index, or a new empty DB if it doesn't exist."""
-    if JsonDB.exists("photos/index"):
-        return JsonDB.get("photos/index")
+def write_file(target, data):
+    """Write a file (making its folder if needed) under a temp name first,
+    and move it into place, so nobody ever sees a partial file."""
+    folder = os.path.dirname(target)
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # Another worker made it first.
+            pass
+
+    partial = "{}.{}.tmp".format(target, uuid.uuid4().hex)
+    with open(partial, "wb") as fh:
+        fh.write(data)
+    os.rename(partial, target)
+
+
+def file_digest(filename):
+    """Get the SHA-256 hash of a file, reading a chunk at a time."""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def photo_filetype(filename):
+    """Get the file type (extension) to save a photo with."""
+    filetype = filename.rsplit(".", 1)[1]
+    if filetype == "jpeg": filetype = "jpg"
+    return filetype
+
+
+def temp_name(filetype):
+    """Get a unique temp file name for an incoming photo."""
+    return os.path.join(Config.site.tempdir, "rophako-photo-{}.{}".format(
+        uuid.uuid4().hex, filetype,
+    ))
+
+
+
+############################################################################
+# Photo Album Documents                                                    #
+#                                                                          #
+# The photo albums are stored across a few documents, so that looking at   #
+# or editing one photo doesn't have to load every photo on the site:       #
+#                                                                          #
+# * photos/catalog: the list of albums and their settings:                 #
+#   {                                                                      #
+#       "album-order": [ album names, in order ],                          #
+#       "albums": {                                                        #
+#           name: { format, description, cover (photo key),               #
+#                   cover-thumb (the cover's thumbnail file name) },       #
+#       },                                                                 #
+#   }                                                                      #
+# * photos/albums/<md5 of album name>: the photos in one album:            #
+#   { "name": album name, "photos": { key: data }, "order": [ keys ],      #
+#     "positions": { key: index in order } }                               #
+#   A photo's data has the file names of its sizes (large, thumb, avatar)  #
+#   and their responsive versions, as "variants":                          #
+#   { size: [ [file type, width, file name], ... ] }                       #
+#   and the sizes' "dimensions": { size: { width, height, bytes } }        #
+# * photos/map: maps photo keys to album names.                            #
+# * photos/files/<ab>: bookkeeping for the photo files (store_photo()),    #
+#   sharded by the first two characters of the file names and upload       #
+#   hashes (for older files, of the hash of the name; see files_prefix()): #
+#   {                                                                      #
+#       "refs": { file name: number of photos using the file },            #
+#       "sources": { hash of an uploaded file: { large, thumb, avatar,     #
+#                    variants } },                                         #
+#       "sources-by-file": { file name: [ hashes of the uploads whose      #
+#                            sizes include the file ] },                   #
+#       "released": { file name: when it stopped being used, to delete it  #
+#                     later (see release_refs()) },                        #
+#   }                                                                      #
+############################################################################
+
+def get_catalog():
+    """Get the photo album catalog, or a new empty one if it doesn't exist."""
+    if not JsonDB.exists("photos/catalog") and JsonDB.exists("photos/index"):
+        migrate_index()
+
+    if JsonDB.exists("photos/catalog"):
+        return JsonDB.get("photos/catalog")
 
     return {
-        "albums": {},      # Album data
-        "map": {},         # Map photo keys to albums
-        "covers": {},      # Album cover photos
-        "photo-order": {}, # Ordering of photos in albums
         "album-order": [], # Ordering of albums themselves
+        "albums": {},      # Album settings and covers
     }
 
 
-def write_index(index):
-    """Save the index back to the DB."""
-    return JsonDB.commit("photos/index", index)
+def write_catalog(catalog):
+    """Save the album catalog back to the DB."""
+    return JsonDB.commit("photos/catalog", catalog)
 
 
-def random_name(filetype):
-    """Get a random available file name to save a new photo."""
-    filetype = filetype.lower()
-    outfile = random_hash() + "." + filetype
-    while os.path.isfile(os.path.join(Config.photo.root_private, outfile)):
-        outfile = random_hash() + "." + filetype
-    return outfile
+def shard_document(album):
+    """Get the DB document name for an album's photos."""
+    digest = hashlib.md5(album.encode("utf-8")).hexdigest()
+    return "photos/albums/{}".format(digest)
+
+
+def get_shard(album):
+    """Get the photos in an album, or None if the album doesn't exist."""
+    if not JsonDB.exists("photos/catalog") and JsonDB.exists("photos/index"):
+        migrate_index()
+    return JsonDB.get(shard_document(album))
+
+
+def write_shard(album, shard):
+    """Save an album's photos back to the DB.
+
+    This also updates the album's `positions`, the map of each photo key to
+    its place in the `order`, which get_photo() uses for navigation."""
+    shard["positions"] = album_positions(shard["order"])
+    return JsonDB.commit(shard_document(album), shard)
+
+
+def album_positions(order):
+    """Map the photo keys in an album's order list to their positions."""
+    return { key: i for i, key in enumerate(order) }
+
+
+def get_map():
+    """Get the map of photo keys to album names."""
+    if not JsonDB.exists("photos/catalog") and JsonDB.exists("photos/index"):
+        migrate_index()
+    return JsonDB.get("photos/map") or dict()
+
+
+def write_map(photo_map):
+    """Save the photo map back to the DB."""
+    return JsonDB.commit("photos/map", photo_map)
+
+
+def update_cover_thumb(album, key, thumb):
+    """Keep the catalog's copy of an album cover's thumbnail up to date, after
+    the thumbnail of photo `key` changed."""
+    catalog = get_catalog()
+    if album in catalog["albums"] and catalog["albums"][album]["cover"] == key:
+        catalog["albums"][album]["cover-thumb"] = thumb
+        write_catalog(catalog)
+
+
+def get_hashes():
+    """Start on a change to the photo file bookkeeping (the `photos/files`
+    documents). Its shards are loaded as they're needed, and the changed
+    ones are saved by write_hashes(). Use it inside albums_locked()."""
+    if JsonDB.exists("photos/hashes"):
+        migrate_hashes()
+    return dict(shards=dict(), changed=set())
+
+
+def write_hashes(hashes):
+    """Save the shards of the photo file bookkeeping that were changed."""
+    for prefix in sorted(hashes["changed"]):
+        shard = hashes["shards"][prefix]
+        delete_released(shard)
+
+        document = "photos/files/{}".format(prefix)
+        if len(shard["refs"]) or len(shard["sources"]) \
+            or len(shard["sources-by-file"]) or len(shard["released"]):
+            JsonDB.commit(document, shard)
+        else:
+            JsonDB.delete(document)
+    hashes["changed"].clear()
+
+
+def files_shard(hashes, name, change=False):
+    """Get the shard of the file bookkeeping that a file name (or the hash
+    of an uploaded file) belongs in. Pass `change` if you're changing it."""
+    prefix = files_prefix(name)
+    if not prefix in hashes["shards"]:
+        hashes["shards"][prefix] = JsonDB.get("photos/files/{}".format(prefix)) \
+            or { "refs": {}, "sources": {}, "sources-by-file": {} }
+        hashes["shards"][prefix].setdefault("released", dict())
+    if change:
+        hashes["changed"].add(prefix)
+    return hashes["shards"][prefix]
+
+
+def files_prefix(name):
+    """Get the shard prefix of a file name or hash: its first two characters
+    (from its hash), or for older files, the start of the hash of its name."""
+    prefix = name[:2].lower()
+    if re.match(r'^[0-9a-f]{2}$', prefix):
+        return prefix
+    return hashlib.md5(name.encode("utf-8")).hexdigest()[:2]
+
+
+def photo_files(photo, sizes=None):
+    """Get the names of the files of a photo (or of a dict of sizes): the
+    given sizes (default all of them), and their variants."""
+    if sizes is None:
+        sizes = ["large", "thumb", "avatar"]
+
+    names = list()
+    for size in sizes:
+        if photo.get(size):
+            names.append(photo[size])
+        for filetype, width, name in photo.get("variants", {}).get(size, []):
+            if not name in names:
+                names.append(name)
+    return names
+
+
+def find_source(digest):
+    """Look up the sizes that were made for an uploaded file before, by the
+    hash of the file.
+
+    Returns the dict of size names to file names, or None if the file hasn't
+    been seen before (or its sizes have been deleted since)."""
+    sizes = files_shard(get_hashes(), digest)["sources"].get(digest)
+    if sizes is None:
+        return None
+
+    for name in photo_files(sizes):
+        if not os.path.isfile(os.path.join(Config.photo.root_private, name)):
+            return None
+    return dict(sizes)
+
+
+def set_source(hashes, digest, sizes):
+    """Remember the sizes that were made for an uploaded file, by the hash of
+    the file (see find_source())."""
+    forget_source(hashes, digest)
+    files_shard(hashes, digest, True)["sources"][digest] = sizes
+    for name in photo_files(sizes):
+        by_file = files_shard(hashes, name, True)["sources-by-file"]
+        by_file.setdefault(name, list()).append(digest)
+
+
+def forget_source(hashes, digest):
+    """Forget the sizes of an uploaded file (see set_source())."""
+    sizes = files_shard(hashes, digest)["sources"].get(digest)
+    if sizes is None:
+        return
+
+    del files_shard(hashes, digest, True)["sources"][digest]
+    for name in photo_files(sizes):
+        by_file = files_shard(hashes, name, True)["sources-by-file"]
+        if digest in by_file.get(name, []):
+            by_file[name].remove(digest)
+            if len(by_file[name]) == 0:
+                del by_file[name]
+
+
+def add_refs(hashes, names):
+    """Count photo files as being used by one more photo."""
+    for name in names:
+        if name:
+            shard = files_shard(hashes, name, True)
+            shard["refs"][name] = shard["refs"].get(name, 0) + 1
+            shard["released"].pop(name, None)
+
+
+def release_refs(hashes, names):
+    """Count photo files as being used by one less photo, and mark the ones
+    that aren't used anymore as released. Files from before photos were
+    content-addressed aren't counted, and are released right away.
+
+    Released files are deleted after `photo.file_grace` seconds, unless a
+    photo uses them again in the meantime: uploads and jobs reuse files
+    that already exist before they're counted (see delete_released())."""
+    for name in names:
+        if not name:
+            continue
+
+        shard = files_shard(hashes, name, True)
+        count = shard["refs"].get(name, 1) - 1
+        if count > 0:
+            shard["refs"][name] = count
+            continue
+        shard["refs"].pop(name, None)
+
+        # Forget uploads whose sizes this file was part of.
+        by_file = files_shard(hashes, name)["sources-by-file"]
+        for digest in list(by_file.get(name, [])):
+            forget_source(hashes, digest)
+
+        logger.debug("Release photo file: {}".format(name))
+        shard["released"][name] = int(time.time())
+
+
+def delete_released(shard):
+    """Delete the files of a shard of the file bookkeeping that were released
+    more than `photo.file_grace` seconds ago, and haven't been written since
+    (see store_photo())."""
+    cutoff = time.time() - int(Config.photo.file_grace)
+    for name, released in list(shard["released"].items()):
+        if released > cutoff:
+            continue
+
+        fname = os.path.join(Config.photo.root_private, name)
+        try:
+            if os.path.getmtime(fname) > cutoff:
+                continue
+            logger.debug("Delete photo file: {}".format(fname))
+            os.unlink(fname)
+        except OSError:
+            pass # Already gone.
+        del shard["released"][name]
+
+
+def sweep_released():
+    """Delete all the released files that are past their grace period (see
+    release_refs()). Use it inside albums_locked()."""
+    hashes = get_hashes()
+    for document in JsonDB.list_docs("photos/files"):
+        if len(files_shard(hashes, document)["released"]):
+            hashes["changed"].add(document)
+    write_hashes(hashes)
+
+
+def release_files(names):
+    """Release photo files (see release_refs()) and save the bookkeeping."""
+    hashes = get_hashes()
+    release_refs(hashes, names)
+    write_hashes(hashes)
+
+
+def migrate_hashes():
+    """Split the old all-in-one `photos/hashes` document into the
+    `photos/files` shards."""
+    old = JsonDB.get("photos/hashes")
+    if old is None:
+        # Another worker beat us to it.
+        return
+    logger.info("Migrating the photo file bookkeeping into shards.")
+
+    hashes = dict(shards=dict(), changed=set())
+    for name, count in old["refs"].items():
+        files_shard(hashes, name, True)["refs"][name] = count
+    for digest, sizes in old["sources"].items():
+        set_source(hashes, digest, sizes)
+    write_hashes(hashes)
+    JsonDB.delete("photos/hashes")
+
+
+def album_documents(album):
+    """Get the names of the DB documents an album page is built from (for
+    `rophako.utils.not_modified()`)."""
+    return ["photos/catalog", shard_document(sanitize_name(album))]
+
+
+def photo_documents(key):
+    """Get the names of the DB documents a photo's page is built from."""
+    album = get_map().get(key)
+    if album is None:
+        return ["photos/map"]
+    return ["photos/map", shard_document(album)]
+
+
+def avatar_stamp():
+    """Get a stamp that changes whenever a photo's avatar may have changed.
+
+    This is the fallback for the `avatars` cache tag (which crop_photo(),
+    rotate_photo() and delete_photo() bump) when Redis isn't available: the
+    newest modification time of the catalog and album documents."""
+    docs = [ "photos/albums/{}".format(doc) for doc in JsonDB.list_docs("photos/albums") ]
+    return max([ JsonDB.mtime(doc) for doc in docs + ["photos/catalog"] ])
+
+
+def migrate_index():
+    """Split the old all-in-one `photos/index` document into the catalog,
+    album and map documents.
+
+    The old index is kept as `photos/backup/index`."""
+    index = JsonDB.get("photos/index")
+    if index is None:
+        # Another worker beat us to it.
+        return
+    logger.info("Migrating the photo album index into per-album documents.")
+
+    catalog = {
+        "album-order": list(index["album-order"]),
+        "albums": {},
+    }
+    for album in index["album-order"]:
+        photos = index["albums"].get(album, {})
+        order = index["photo-order"].get(album, [])
+        settings = index.get("settings", {}).get(album, {})
+
+        cover = index["covers"].get(album, "")
+        if not cover in photos:
+            cover = order[0] if len(order) else ""
+
+        catalog["albums"][album] = {
+            "format": settings.get("format", "classic"),
+            "description": settings.get("description") or "",
+            "cover": cover,
+            "cover-thumb": photos[cover]["thumb"] if cover else "",
+        }
+        write_shard(album, dict(name=album, photos=photos, order=order))
+
+    write_map(index["map"])
+    JsonDB.commit("photos/backup/index", index)
+    write_catalog(catalog)
+    JsonDB.delete("photos/index")
 
 
 def random_hash():
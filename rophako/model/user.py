@@ -79,6 +79,7 @@ def update_user(uid, data):
 
     db.update(data)
     JsonDB.commit("users/by-id/{}".format(uid), db)
+    JsonDB.invalidate_tags("users", "user:{}".format(uid))
 
 
 def delete_user(uid):
@@ -130,15 +131,122 @@ def get_user(uid=None, username=None):
 
 def get_picture(uid):
     """Get the chosen profile photo for the user."""
-    data = get_user(uid=uid)
-    pic = data["picture"]
-    if len(pic):
-        photo = Photo.get_photo(pic)
-        if photo:
-            return photo["avatar"]
+    profile = get_profile(uid)
+    if profile:
+        return profile["avatar"]
     return None
 
 
+# In-memory cache of user profiles, for the listing pages that show the
+# author of every post or comment. Maps user IDs to (stamp, profile).
+PROFILE_CACHE = dict()
+
+def get_profile(uid):
+    """Get the public profile of a user, or None if not found.
+
+    See `get_profiles()`."""
+    return get_profiles([uid]).get(int(uid))
+
+
+def get_profiles(uids):
+    """Get the public profiles of several users at once.
+
+    A profile is the small part of a user's account that pages show about
+    them: their `uid`, `username`, `name`, `role` and `avatar` (the file name
+    of their profile picture's avatar, or None). Profiles are cached in
+    memory, and are reloaded only when the user's account or the photo
+    albums have changed.
+
+    The profiles are shared, so don't modify them.
+
+    Returns a dict of user IDs to profiles. Users that don't exist are left
+    out."""
+    uids = sorted(set([ int(uid) for uid in uids ]))
+    stamps = get_stamps(uids, avatars=True)
+
+    result = dict()
+    for uid in uids:
+        stamp = stamps[uid]
+        cached = PROFILE_CACHE.get(uid)
+        if cached and cached[0] == stamp:
+            result[uid] = cached[1]
+            continue
+
+        db = get_user(uid=uid)
+        if not db:
+            PROFILE_CACHE.pop(uid, None)
+            continue
+
+        # Look up the avatar for their profile picture.
+        avatar = None
+        if len(db["picture"]):
+            photo = Photo.get_photo(db["picture"])
+            if photo and photo["avatar"]:
+                avatar = photo["avatar"]
+
+        profile = dict(
+            uid=db["uid"],
+            username=db["username"],
+            name=db["name"],
+            role=db["role"],
+            avatar=avatar,
+        )
+        PROFILE_CACHE[uid] = (stamp, profile)
+        result[uid] = profile
+
+    return result
+
+
+def get_stamp(uid):
+    """Get the version stamp of a user's account.
+
+    The stamp changes whenever the account is updated or deleted, so the
+    login session can hang on to a copy of the user's details and only
+    refresh them when the stamp changes. It's a cache tag in Redis, or the
+    user's DB file's modification time if Redis isn't available."""
+    return get_stamps([uid])[int(uid)]
+
+
+def profile_documents(uids):
+    """Get the names of the DB documents that users' profiles are built from
+    (for `rophako.utils.not_modified()`): their accounts, and the albums of
+    their profile pictures."""
+    docs = list()
+    for uid in sorted(set([ int(uid) for uid in uids ])):
+        docs.append("users/by-id/{}".format(uid))
+        db = get_user(uid=uid)
+        if db and len(db["picture"]):
+            for doc in Photo.photo_documents(db["picture"]):
+                if not doc in docs:
+                    docs.append(doc)
+    return docs
+
+
+def get_stamps(uids, avatars=False):
+    """Get the version stamps of several users' accounts at once.
+
+    With `avatars`, each stamp also changes when any profile picture may have
+    changed (photos being cropped, rotated or deleted; see
+    `Photo.avatar_stamp()`)."""
+    uids = [ int(uid) for uid in uids ]
+    tags = [ "user:{}".format(uid) for uid in uids ]
+    if avatars:
+        tags.append("avatars")
+
+    versions = JsonDB.get_tag_versions(tags)
+    if versions is not None:
+        stamps = { uid: "v{}".format(versions[tag]) for uid, tag in zip(uids, tags) }
+        suffix = "/v{}".format(versions["avatars"]) if avatars else ""
+    else:
+        stamps = {
+            uid: "m{}".format(JsonDB.mtime("users/by-id/{}".format(uid)))
+            for uid in uids
+        }
+        suffix = "/m{}".format(Photo.avatar_stamp()) if avatars else ""
+
+    return { uid: stamp + suffix for uid, stamp in stamps.items() }
+
+
 def exists(uid=None, username=None):
     """Query whether a user ID or name exists."""
     if uid:
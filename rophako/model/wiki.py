@@ -42,6 +42,20 @@ def render_page(content):
     return html
 
 
+def linked_documents(content):
+    """Get the names of the DB documents of the pages that a Wiki page links
+    to (for `rophako.utils.not_modified()`). The links look different
+    depending on whether the pages exist, so the page changes when they're
+    created or deleted."""
+    docs = list()
+    for match in re.findall(r'\[\[(.+?)\]\]', content):
+        page = match.split("|", 2)[1] if "|" in match else match
+        doc = "wiki/pages/{}".format(page)
+        if not doc in docs:
+            docs.append(doc)
+    return docs
+
+
 def get_page(name):
     """Get a Wiki page. Returns `None` if the page isn't found."""
     name = name.strip("/") # Remove any surrounding slashes.
@@ -67,10 +81,11 @@ def edit_page(name, author, body, note, history=True):
     # Get the old page first.
     page = get_page(name)
     if not page:
-        # Initialize the page.
+        # Initialize the page. Links to it from other pages aren't broken now.
         page = dict(
             revisions=[],
         )
+        JsonDB.invalidate_tags("wiki")
 
     # The new revision to be added.
     rev = dict(
@@ -94,6 +109,7 @@ def edit_page(name, author, body, note, history=True):
     # Write it.
     logger.info("Write to Wiki page {}".format(name))
     JsonDB.commit("wiki/pages/{}".format(name), page)
+    JsonDB.invalidate_tags("wiki:{}".format(name))
     return True
 
 
@@ -121,6 +137,7 @@ def delete_history(name, revision):
 
     page["revisions"] = history
     JsonDB.commit("wiki/pages/{}".format(name), page)
+    JsonDB.invalidate_tags("wiki:{}".format(name))
 
     return True
 
@@ -133,6 +150,7 @@ def delete_page(name):
     if JsonDB.exists(path):
         logger.info("Delete Wiki page {}".format(name))
         JsonDB.delete(path)
+        JsonDB.invalidate_tags("wiki", "wiki:{}".format(name))
 
     return True
 
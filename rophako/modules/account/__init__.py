@@ -35,6 +35,7 @@ def login():
             session["uid"]  = db["uid"]
             session["name"] = db["name"]
             session["role"] = db["role"]
+            session["user_stamp"] = User.get_stamp(db["uid"])
 
             # Redirect them to a local page?
             url = request.form.get("url", "")
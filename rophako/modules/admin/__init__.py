@@ -8,6 +8,7 @@ from flask import g, Blueprint, request, redirect, url_for, session, flash
 import rophako.model.user as User
 import rophako.model.blog as Blog
 import rophako.model.tracking as Tracking
+import rophako.model.photo as Photo
 from rophako.modules.account import validate_create_form
 from rophako.utils import template, admin_required
 
@@ -199,3 +200,11 @@ def rebuild_blog_index():
     Blog.rebuild_index()
     flash("Blog index rebuilt.")
     return redirect(url_for(".index"))
+
+@mod.route("/maint/backfill_photo_dimensions")
+@admin_required
+def backfill_photo_dimensions():
+    """Record the dimensions of older photos."""
+    Photo.backfill_dimensions()
+    flash("The photo dimensions are being recorded in the background.")
+    return redirect(url_for(".index"))
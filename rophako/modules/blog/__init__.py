@@ -3,18 +3,19 @@ from __future__ import unicode_literals, absolute_import
 
 """Endpoints for the web blog."""
 
-from flask import Blueprint, g, request, redirect, url_for, flash, make_response
-import datetime
+from flask import (Blueprint, g, request, redirect, url_for, flash, Response,
+    stream_with_context)
 import time
 import re
-from xml.dom.minidom import Document
+from xml.sax.saxutils import escape, quoteattr
 
 import rophako.model.user as User
 import rophako.model.blog as Blog
 import rophako.model.comment as Comment
 import rophako.model.emoticons as Emoticons
-from rophako.utils import (template, render_markdown, pretty_time,
-    login_required, remote_addr)
+from rophako.utils import (template, stream_template, render_markdown,
+    pretty_time, pretty_times, login_required, remote_addr, cacheable, cache_tags,
+    not_modified)
 from rophako.plugin import load_plugin
 from rophako.settings import Config
 from rophako.log import logger
@@ -28,6 +29,7 @@ mod = Blueprint("blog", __name__, url_prefix="/blog")
 load_plugin("rophako.modules.comment")
 
 @mod.route("/")
+@cacheable
 def index():
     return template("blog/index.html")
 
@@ -35,47 +37,30 @@ def index():
 @mod.route("/archive")
 def archive():
     """List all blog posts over time on one page."""
-    index = Blog.get_index()
-
-    # Group by calendar month, and keep track of friendly versions of months.
-    groups = dict()
-    friendly_months = dict()
-    for post_id, data in index.items():
-        ts = datetime.datetime.fromtimestamp(data["time"])
-        date = ts.strftime("%Y-%m")
-        if not date in groups:
-            groups[date] = dict()
-            friendly = ts.strftime("%B %Y")
-            friendly_months[date] = friendly
-
-        # Get author's profile && Pretty-print the time.
-        data["profile"] = User.get_user(uid=data["author"])
-        data["pretty_time"] = pretty_time(Config.blog.time_format, data["time"])
-        groups[date][post_id] = data
-
-    # Sort by calendar month.
-    sort_months = sorted(groups.keys(), reverse=True)
-
-    # Prepare the results.
-    result = list()
-    for month in sort_months:
-        data = dict(
-            month=month,
-            month_friendly=friendly_months[month],
-            posts=list()
-        )
+    g.info["archive"] = archive_months(Blog.get_archive())
+    return stream_template("blog/archive.html")
 
-        # Sort the posts by time created, descending.
-        for post_id in sorted(groups[month].keys(), key=lambda x: groups[month][x]["time"], reverse=True):
-            data["posts"].append(groups[month][post_id])
 
-        result.append(data)
+def archive_months(months):
+    """Fill in the authors and times of the posts in the archive.
 
-    g.info["archive"] = result
-    return template("blog/archive.html")
+    This is a generator, so the work happens while the page is being streamed
+    out instead of before the first byte is sent."""
+    authors = User.get_profiles([
+        post["author"] for month in months for post in month["posts"]
+    ])
+    for month in months:
+        times = pretty_times(Config.blog.time_format,
+            [ post["time"] for post in month["posts"] ])
+        for post, pretty in zip(month["posts"], times):
+            # Get author's profile && Pretty-print the time.
+            post["profile"] = authors.get(int(post["author"]))
+            post["pretty_time"] = pretty
+        yield month
 
 
 @mod.route("/category/<category>")
+@cacheable
 def category(category):
     g.info["url_category"] = category
     return template("blog/index.html")
@@ -93,6 +78,7 @@ def private():
     return template("blog/private.html")
 
 @mod.route("/entry/<fid>")
+@cacheable
 def entry(fid):
     """Endpoint to view a specific blog entry."""
 
@@ -119,9 +105,20 @@ def entry(fid):
         return redirect(url_for(".index"))
 
     # Look up the post.
+    cache_tags("blog", "post:{}".format(post_id), "users", "avatars")
     post = Blog.get_entry(post_id)
     post["post_id"] = post_id
 
+    # Does the browser already have the latest copy?
+    unchanged = not_modified(
+        "blog/index",
+        "blog/entries/{}".format(post_id),
+        *Comment.thread_documents("blog-{}".format(post_id)) +
+        User.profile_documents([post["author"]])
+    )
+    if unchanged is not None:
+        return unchanged
+
     # Body has a snipped section?
     if "<snip>" in post["body"]:
         post["body"] = re.sub(r'\s*<snip>\s*', '\n\n', post["body"])
@@ -137,8 +134,8 @@ def entry(fid):
         post["rendered_body"] = Emoticons.render(post["rendered_body"])
 
     # Get the author's information.
-    post["profile"] = User.get_user(uid=post["author"])
-    post["photo"]   = User.get_picture(uid=post["author"])
+    post["profile"] = User.get_profile(post["author"])
+    post["photo"]   = post["profile"]["avatar"] if post["profile"] else None
     post["photo_url"] = Config.photo.root_public
 
     # Pretty-print the time.
@@ -317,27 +314,100 @@ def delete():
 
 
 @mod.route("/rss")
-def rss():
-    """RSS feed for the blog."""
-    doc = Document()
+@mod.route("/category/<category>/rss")
+def rss(category=None):
+    """RSS 2.0 feed for the blog, or for one of its categories."""
+    return feed("rss", category)
+
+
+@mod.route("/atom")
+@mod.route("/category/<category>/atom")
+def atom(category=None):
+    """Atom feed for the blog, or for one of its categories."""
+    return feed("atom", category)
+
+
+def feed(kind, category=None):
+    """Serve a blog feed.
+
+    The feed is streamed out to the browser while it's being written. For
+    visitors who aren't logged in, the finished XML is also cached until the
+    blog index changes next.
+
+    Args:
+        kind (str): the feed format, `rss` or `atom`.
+        category (str): only include the posts from this category.
+    """
+
+    # Feed readers poll this constantly; every change to a post updates the
+    # index.
+    unchanged = not_modified("blog/index")
+    if unchanged is not None:
+        return unchanged
+
+    # Full posts, or only the part above the <snip>?
+    mode = request.args.get("mode", Config.blog.feed_mode)
+    if not mode in ["full", "summary"]:
+        mode = "full"
+
+    content_type = "application/{}+xml; charset=utf-8".format(kind)
+
+    # The feed's own address, built the same way for every request that
+    # shares its cached copy.
+    self_url = url_for(".{}".format(kind), category=category,
+        mode=mode if mode != Config.blog.feed_mode else None, _external=True)
+
+    # The feed's links are built from the URL it was requested at, and
+    # logged-in users can see private posts.
+    cache_name = None
+    if not g.info["session"]["login"]:
+        cache_name = "{}/{}/{}/{}".format(kind, mode, category or "",
+            request.url_root)
+        xml = Blog.get_feed_cache(cache_name)
+        if xml is not None:
+            return Response(xml, content_type=content_type)
+
+    # Get the posts that go in the feed.
+    mtime = Blog.index_mtime()
+    index = Blog.get_index()
+    if category is not None:
+        if category == Config.blog.default_category:
+            category = ""
+        index = {
+            post_id: data for post_id, data in index.items() \
+                if category in data["categories"]
+        }
+    posts = get_index_posts(index)[:int(Config.blog.entries_per_feed)]
+
+    if kind == "rss":
+        chunks = rss_feed(posts, mode)
+    else:
+        chunks = atom_feed(posts, mode, self_url)
+    if cache_name is not None:
+        chunks = cache_feed(chunks, cache_name, mtime)
+
+    return Response(stream_with_context(chunks), content_type=content_type)
 
-    rss = doc.createElement("rss")
-    rss.setAttribute("version", "2.0")
-    rss.setAttribute("xmlns:blogChannel", "http://backend.userland.com/blogChannelModule")
-    doc.appendChild(rss)
 
-    channel = doc.createElement("channel")
-    rss.appendChild(channel)
+def rss_feed(posts, mode):
+    """Write an RSS 2.0 feed, one piece at a time.
 
+    Args:
+        posts (list): the post IDs to include, in order.
+        mode (str): `full` or `summary`, see `feed_entries()`.
+    """
     rss_time = "%a, %d %b %Y %H:%M:%S GMT"
+    today = time.strftime(rss_time, time.gmtime())
+
+    yield '<?xml version="1.0" encoding="utf-8"?>\n'
+    yield '<rss version="2.0" xmlns:blogChannel="http://backend.userland.com/blogChannelModule">\n'
+    yield '\t<channel>\n'
 
     ######
     ## Channel Information
     ######
 
-    today = time.strftime(rss_time, time.gmtime())
-
-    xml_add_text_tags(doc, channel, [
+    yield xml_text_tags(2, [
         ["title", Config.blog.title],
         ["link", Config.blog.link],
         ["description", Config.blog.description],
@@ -352,9 +422,8 @@ def rss():
     ## Image Information
     ######
 
-    image = doc.createElement("image")
-    channel.appendChild(image)
-    xml_add_text_tags(doc, image, [
+    yield '\t\t<image>\n'
+    yield xml_text_tags(3, [
         ["title", Config.blog.image_title],
         ["url", Config.blog.image_url],
         ["link", Config.blog.link],
@@ -362,49 +431,125 @@ def rss():
         ["height", Config.blog.image_height],
         ["description", Config.blog.image_description],
     ])
+    yield '\t\t</image>\n'
 
     ######
     ## Add the blog posts
     ######
 
-    index = Blog.get_index()
-    posts = get_index_posts(index)
-    for post_id in posts[:int(Config.blog.entries_per_feed)]:
+    for post in feed_entries(posts, mode):
+        yield '\t\t<item>\n'
+        yield xml_text_tags(3, [
+            ["title", post["subject"]],
+            ["link", post["url"]],
+            ["guid", post["url"]],
+            ["description", post["rendered_body"]],
+            ["pubDate", time.strftime(rss_time, time.gmtime(post["time"]))],
+        ])
+        yield '\t\t</item>\n'
+
+    yield '\t</channel>\n'
+    yield '</rss>\n'
+
+
+def atom_feed(posts, mode, self_url):
+    """Write an Atom feed, one piece at a time.
+
+    Takes the same arguments as `rss_feed()`, plus the feed's own URL."""
+    atom_time = "%Y-%m-%dT%H:%M:%SZ"
+
+    yield '<?xml version="1.0" encoding="utf-8"?>\n'
+    yield '<feed xmlns="http://www.w3.org/2005/Atom">\n'
+    yield xml_text_tags(1, [
+        ["title", Config.blog.title],
+        ["subtitle", Config.blog.description],
+        ["id", Config.blog.link],
+        ["rights", Config.blog.copyright],
+        ["logo", Config.blog.image_url],
+        ["updated", time.strftime(atom_time, time.gmtime(Blog.index_mtime()))],
+    ])
+    yield '\t<link href={} />\n'.format(quoteattr(Config.blog.link))
+    yield '\t<link rel="self" href={} />\n'.format(quoteattr(self_url))
+
+    body_tag = "content" if mode == "full" else "summary"
+    for post in feed_entries(posts, mode):
+        yield '\t<entry>\n'
+        yield xml_text_tags(2, [
+            ["title", post["subject"]],
+            ["id", post["url"]],
+            ["published", time.strftime(atom_time, time.gmtime(post["time"]))],
+            ["updated", time.strftime(atom_time, time.gmtime(post["time"]))],
+        ])
+        yield '\t\t<link href={} />\n'.format(quoteattr(post["url"]))
+        yield '\t\t<author><name>{}</name></author>\n'.format(
+            escape(unicode(post["author_name"]))
+        )
+        yield '\t\t<{tag} type="html">{body}</{tag}>\n'.format(
+            tag=body_tag,
+            body=escape(post["rendered_body"]),
+        )
+        yield '\t</entry>\n'
+
+    yield '</feed>\n'
+
+
+def feed_entries(posts, mode):
+    """Load and render the blog posts for a feed, one at a time.
+
+    In `summary` mode, only the part of a post above its `<snip>` is
+    included (or its first paragraph, if it has no snip)."""
+    for post_id in posts:
         post = Blog.get_entry(post_id)
-        item = doc.createElement("item")
-        channel.appendChild(item)
+
+        # Cut it down to a summary?
+        body = post["body"]
+        if mode == "summary":
+            if "<snip>" in body:
+                body = body.split("<snip>")[0]
+            else:
+                body = re.split(r'\r?\n\s*\r?\n', body.strip())[0]
+        else:
+            body = re.sub(r'\s*<snip>\s*', '\n\n', body)
 
         # Render the body.
         if post["format"] == "markdown":
-            post["rendered_body"] = render_markdown(post["body"])
+            post["rendered_body"] = render_markdown(body)
         else:
-            post["rendered_body"] = post["body"]
+            post["rendered_body"] = body
 
         # Render emoticons.
         if post["emoticons"]:
             post["rendered_body"] = Emoticons.render(post["rendered_body"])
 
-        xml_add_text_tags(doc, item, [
-            ["title", post["subject"]],
-            ["link", url_for("blog.entry", fid=post["fid"], _external=True)],
-            ["description", post["rendered_body"]],
-            ["pubDate", time.strftime(rss_time, time.gmtime(post["time"]))],
-        ])
+        # Get the author's name.
+        profile = User.get_profile(post["author"])
+        post["author_name"] = profile["name"] if profile else "Anonymous"
 
-    resp = make_response(doc.toprettyxml(encoding="utf-8"))
-    resp.headers["Content-Type"] = "application/rss+xml; charset=utf-8"
-    return resp
+        post["url"] = url_for("blog.entry", fid=post["fid"], _external=True)
+        yield post
 
 
-def xml_add_text_tags(doc, root_node, tags):
-    """RSS feed helper function.
+def cache_feed(chunks, name, mtime):
+    """Pass a feed through to the browser, and cache it once it's done."""
+    xml = []
+    for chunk in chunks:
+        xml.append(chunk)
+        yield chunk
+    Blog.set_feed_cache(name, mtime, "".join(xml))
 
-    Add a collection of simple tag/text pairs to a root XML element."""
-    for pair in tags:
-        name, value = pair
-        channelTag = doc.createElement(name)
-        channelTag.appendChild(doc.createTextNode(unicode(value)))
-        root_node.appendChild(channelTag)
+
+def xml_text_tags(depth, tags):
+    """Feed helper function.
+
+    Write a collection of simple tag/text pairs, indented `depth` tabs."""
+    indent = "\t" * depth
+    return "".join([
+        "{indent}<{name}>{value}</{name}>\n".format(
+            indent=indent,
+            name=name,
+            value=escape(unicode(value)),
+        ) for name, value in tags
+    ])
 
 
 def partial_index(template_name="blog/index.inc.html", mode="normal"):
@@ -419,6 +564,7 @@ def partial_index(template_name="blog/index.inc.html", mode="normal"):
     """
 
     # Get the blog index.
+    cache_tags("blog", "users", "avatars")
     if mode == "normal":
         index = Blog.get_index()
     elif mode == "drafts":
@@ -480,6 +626,11 @@ def partial_index(template_name="blog/index.inc.html", mode="normal"):
     stop = offset + int(Config.blog.entries_per_page)
     if stop > len(posts): stop = len(posts)
     index = 1 # Let each post know its position on-page.
+    cache_tags(*[ "thread:blog-{}".format(posts[i]) for i in range(offset, stop) ])
+    authors = User.get_profiles([ pool[posts[i]]["author"] for i in range(offset, stop) ])
+    comment_counts = Comment.count_comments_many([
+        "blog-{}".format(posts[i]) for i in range(offset, stop)
+    ])
     for i in range(offset, stop):
         post_id = posts[i]
         post    = Blog.get_entry(post_id)
@@ -502,14 +653,14 @@ def partial_index(template_name="blog/index.inc.html", mode="normal"):
             post["rendered_body"] = Emoticons.render(post["rendered_body"])
 
         # Get the author's information.
-        post["profile"] = User.get_user(uid=post["author"])
-        post["photo"]   = User.get_picture(uid=post["author"])
+        post["profile"] = authors.get(int(post["author"]))
+        post["photo"]   = post["profile"]["avatar"] if post["profile"] else None
         post["photo_url"] = Config.photo.root_public
 
         post["pretty_time"] = pretty_time(Config.blog.time_format, post["time"])
 
         # Count the comments for this post
-        post["comment_count"] = Comment.count_comments("blog-{}".format(post_id))
+        post["comment_count"] = comment_counts["blog-{}".format(post_id)]
         post["position_index"] = index
         index += 1
 
@@ -3,12 +3,13 @@ from __future__ import unicode_literals, absolute_import
 
 """Endpoints for the commenting subsystem."""
 
-from flask import Blueprint, g, request, redirect, url_for, flash
+from flask import Blueprint, g, request, redirect, url_for, flash, jsonify
 import time
 
 import rophako.model.user as User
 import rophako.model.comment as Comment
-from rophako.utils import (template, pretty_time, sanitize_name, remote_addr)
+from rophako.utils import (template, pretty_time, pretty_times, sanitize_name,
+    remote_addr, cache_tags)
 from rophako.plugin import load_plugin
 from rophako.settings import Config
 
@@ -50,9 +51,6 @@ def preview():
 
     # Are they submitting?
     if form["action"] == "submit":
-        # Make sure they have a deletion token in their session.
-        token = Comment.deletion_token()
-
         Comment.add_comment(
             thread=thread,
             uid=g.info["session"]["uid"],
@@ -63,7 +61,6 @@ def preview():
             subject=form["subject"],
             message=form["message"],
             url=form["url"],
-            token=token,
         )
 
         # Are we subscribing to the thread?
@@ -204,9 +201,39 @@ def unsubscribe():
     return template("comment/unsubscribed.html")
 
 
+@mod.route("/page/<thread>")
+def page(thread):
+    """Get the next page of a comment thread, for the "load more" link.
+
+    The `after` parameter is the cursor from the page before, and `url` is
+    the address of the page that the comments are on. Returns JSON with the
+    `html` of the comments and the `next` page's cursor (null at the end)."""
+    thread = sanitize_name(thread)
+    try:
+        comments, total, cursor = Comment.get_page(thread,
+            after=request.args.get("after"),
+            limit=int(Config.comment.per_page),
+            newest=Config.comment.order == "newest",
+        )
+    except ValueError:
+        return jsonify(error="Invalid cursor."), 400
+
+    g.info["thread"] = thread
+    g.info["url"] = request.args.get("url", "")
+    g.info["comments"] = prepare_comments(thread, comments)
+    g.info["photo_url"] = Config.photo.root_public
+    return jsonify(
+        html=template("comment/comments.inc.html"),
+        next=cursor,
+    )
+
+
 def partial_index(thread, subject, header=True, addable=True):
     """Partial template for including the index view of a comment thread.
 
+    Only the first page of the comments is included; the rest are loaded by
+    the browser from the ``page`` endpoint.
+
     Parameters:
         thread (str): the unique name for the comment thread.
         subject (str): subject name for the comment thread.
@@ -214,43 +241,51 @@ def partial_index(thread, subject, header=True, addable=True):
         addable (bool): can new comments be added to the thread?
     """
 
-    # Get all the comments on this thread.
-    comments = Comment.get_comments(thread)
+    # Get the first page of comments on this thread.
+    cache_tags("thread:{}".format(thread), "users", "avatars")
+    comments, total, cursor = Comment.get_page(thread,
+        limit=int(Config.comment.per_page),
+        newest=Config.comment.order == "newest",
+    )
 
-    # Sort the comments by most recent on bottom.
-    sorted_cids = [ x for x in sorted(comments, key=lambda y: comments[y]["time"]) ]
-    sorted_comments = []
-    for cid in sorted_cids:
-        comment = comments[cid]
-        comment["id"] = cid
+    g.info["header"] = header
+    g.info["thread"] = thread
+    g.info["subject"] = subject
+    g.info["commenting_disabled"] = not addable
+    g.info["url"] = request.url
+    g.info["comments"] = prepare_comments(thread, comments)
+    g.info["total"] = total
+    g.info["cursor"] = cursor
+    g.info["photo_url"] = Config.photo.root_public
+    return template("comment/index.inc.html")
 
+
+def prepare_comments(thread, comments):
+    """Get a page of comments (from ``Comment.get_page()``) ready to show."""
+    times = pretty_times(Config.comment.time_format,
+        [ comment["time"] for comment in comments ])
+    profiles = User.get_profiles([
+        comment["uid"] for comment in comments if comment["uid"] > 0
+    ])
+    for comment, pretty in zip(comments, times):
         # Was the commenter logged in?
-        if comment["uid"] > 0:
-            user = User.get_user(uid=comment["uid"])
-            avatar = User.get_picture(uid=comment["uid"])
+        user = profiles.get(int(comment["uid"]))
+        if user:
             comment["name"] = user["name"]
             comment["username"] = user["username"]
-            comment["image"] = avatar
+            comment["image"] = user["avatar"]
 
         # Add the pretty time.
-        comment["pretty_time"] = pretty_time(Config.comment.time_format, comment["time"])
+        comment["pretty_time"] = pretty
 
         # Format the message for display.
-        comment["formatted_message"] = Comment.format_message(comment["message"])
+        comment["formatted_message"] = Comment.formatted_message(thread,
+            comment["id"], comment["message"])
 
         # Was this comment posted by the current user viewing it?
-        comment["editable"] = Comment.is_editable(thread, cid, comment)
-
-        sorted_comments.append(comment)
+        comment["editable"] = Comment.is_editable(thread, comment["id"], comment)
 
-    g.info["header"] = header
-    g.info["thread"] = thread
-    g.info["subject"] = subject
-    g.info["commenting_disabled"] = not addable
-    g.info["url"] = request.url
-    g.info["comments"] = sorted_comments
-    g.info["photo_url"] = Config.photo.root_public
-    return template("comment/index.inc.html")
+    return comments
 
 
 def get_comment_form(form):
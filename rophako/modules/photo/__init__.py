@@ -3,12 +3,17 @@ from __future__ import unicode_literals, absolute_import
 
 """Endpoints for the photo albums."""
 
-from flask import Blueprint, g, request, redirect, url_for, flash
+from flask import (Blueprint, g, request, redirect, url_for, flash, abort,
+    send_file, make_response)
+import mimetypes
+import os
 
 import rophako.model.user as User
 import rophako.model.photo as Photo
-from rophako.utils import (template, pretty_time, render_markdown,
-    login_required, ajax_response)
+import rophako.model.comment as Comment
+from rophako.utils import (template, stream_template, pretty_time,
+    render_markdown, login_required, ajax_response, cacheable, cache_tags,
+    not_modified)
 from rophako.plugin import load_plugin
 from rophako.settings import Config
 
@@ -34,8 +39,16 @@ def albums():
 
 
 @mod.route("/album/<name>")
+@cacheable
 def album_index(name):
     """View the photos inside an album."""
+    cache_tags("album:{}".format(name))
+
+    # Does the browser already have the latest copy?
+    unchanged = not_modified(*Photo.album_documents(name))
+    if unchanged is not None:
+        return unchanged
+
     photos = Photo.list_photos(name)
     if photos is None:
         flash("That album doesn't exist.")
@@ -49,23 +62,34 @@ def album_index(name):
     g.info["markdown"]   = render_markdown(g.info["album_info"]["description"])
     g.info["photos"]     = photos
 
-    # Render Markdown descriptions for photos.
+    # Render Markdown descriptions for photos, and get their srcsets.
     for photo in g.info["photos"]:
         photo["data"]["markdown"] = render_markdown(photo["data"].get("description", ""))
+        photo["data"]["sources"] = Photo.get_sources(photo["data"])
 
-    return template("photos/album.html")
+    return stream_template("photos/album.html")
 
 
 @mod.route("/view/<key>")
+@cacheable
 def view_photo(key):
     """View a specific photo."""
+
+    cache_tags("album:{}".format(Photo.get_map().get(key)), "users")
     photo = Photo.get_photo(key)
     if photo is None:
         flash("That photo wasn't found!")
         return redirect(url_for(".albums"))
 
+    # Does the browser already have the latest copy?
+    unchanged = not_modified(*Photo.photo_documents(key) +
+        Comment.thread_documents("photos-{}".format(key)) +
+        User.profile_documents([photo["author"]]))
+    if unchanged is not None:
+        return unchanged
+
     # Get the author info.
-    author = User.get_user(uid=photo["author"])
+    author = User.get_profile(photo["author"])
     if author:
         g.info["author"] = author
 
@@ -73,9 +97,29 @@ def view_photo(key):
     g.info["photo"]["key"] = key
     g.info["photo"]["pretty_time"] = pretty_time(Config.photo.time_format, photo["uploaded"])
     g.info["photo"]["markdown"] = render_markdown(photo.get("description", ""))
+    g.info["photo"]["sources"] = Photo.get_sources(photo)
     return template("photos/view.html")
 
 
+@mod.route("/img/<key>/<int:width>x<int:height>")
+def resized(key, width, height):
+    """Get a photo in one of the other sizes (see Photo.get_resized())."""
+    outfile = Photo.get_resized(key, width, height)
+    if outfile is None:
+        abort(404)
+
+    # Let the web server send it?
+    if Config.photo.img_accel:
+        response = make_response("")
+        response.headers["X-Accel-Redirect"] = "/".join([
+            Config.photo.img_accel.rstrip("/"), outfile,
+        ])
+        response.headers["Content-Type"] = mimetypes.guess_type(outfile)[0]
+        return response
+
+    return send_file(os.path.join(Config.photo.img_cache, outfile))
+
+
 @mod.route("/upload", methods=["GET", "POST"])
 @login_required
 def upload():
@@ -145,6 +189,14 @@ def crop(photo):
         flash("The photo you want to crop wasn't found!")
         return redirect(url_for(".albums"))
 
+    # Still working on the last upload or crop?
+    if pic.get("processing"):
+        if request.method == "POST":
+            flash("The photo is still being processed; try again in a moment.")
+        g.info["photo"] = photo
+        g.info["processing"] = True
+        return template("photos/crop.html")
+
     # Saving?
     if request.method == "POST":
         try:
@@ -157,7 +209,7 @@ def crop(photo):
 
         # Re-crop the photo!
         Photo.crop_photo(photo, x, y, length)
-        flash("The photo has been cropped!")
+        flash("The photo is being cropped! The new thumbnail will be ready in a moment.")
         return redirect(url_for(".albums")) # TODO go to photo
 
     # Get the photo's true size.
@@ -215,7 +267,10 @@ def edit(key):
 
         # Rotating the photo?
         if rotate in ["left", "right", "180"]:
-            Photo.rotate_photo(key, rotate)
+            if pic.get("processing"):
+                flash("The photo can't be rotated while it's still being processed.")
+            else:
+                Photo.rotate_photo(key, rotate)
 
         flash("The photo has been updated.")
         return redirect(url_for(".view_photo", key=key))
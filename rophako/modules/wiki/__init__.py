@@ -8,7 +8,8 @@ from flask import Blueprint, g, request, redirect, url_for, flash
 import rophako.model.user as User
 import rophako.model.wiki as Wiki
 import rophako.model.emoticons as Emoticons
-from rophako.utils import template, pretty_time, render_markdown, login_required
+from rophako.utils import (template, pretty_time, pretty_times,
+    render_markdown, login_required, cacheable, cache_tags, not_modified)
 from rophako.settings import Config
 
 mod = Blueprint("wiki", __name__, url_prefix="/wiki")
@@ -31,6 +32,7 @@ def list_pages():
 
 
 @mod.route("/<path:name>")
+@cacheable
 def view_page(name):
     """Show a specific wiki page."""
     link = name
@@ -39,7 +41,9 @@ def view_page(name):
     g.info["link"] = link
     g.info["title"] = name
 
-    # Look up the page.
+    # Look up the page. Links to other pages look different depending on
+    # whether they exist, so the page depends on the whole wiki's page list.
+    cache_tags("wiki", "wiki:{}".format(name), "users")
     page = Wiki.get_page(name)
     if not page:
         # Page doesn't exist... yet!
@@ -63,6 +67,14 @@ def view_page(name):
         # Show the latest one.
         rev = page["revisions"][0]
 
+    # Does the browser already have the latest copy? The page shows whether
+    # the pages it links to exist, and who wrote it.
+    unchanged = not_modified("wiki/pages/{}".format(name.strip("/")),
+        *Wiki.linked_documents(rev["body"]) +
+        User.profile_documents([rev["author"]]))
+    if unchanged is not None:
+        return unchanged
+
     # Getting the plain text source?
     if request.args.get("source", None):
         g.info["markdown"] = render_markdown("\n".join([
@@ -80,7 +92,7 @@ def view_page(name):
     g.info["pretty_time"] = pretty_time(Config.wiki.time_format, rev["time"])
 
     # Author info
-    g.info["author"] = User.get_user(uid=rev["author"])
+    g.info["author"] = User.get_profile(rev["author"])
 
     return template("wiki/page.html")
 
@@ -96,18 +108,16 @@ def history(name):
         flash("Wiki page not found.")
         return redirect(url_for(".index"))
 
-    authors = dict()
+    authors = User.get_profiles([ rev["author"] for rev in page["revisions"] ])
     history = list()
-    for rev in page["revisions"]:
-        uid = rev["author"]
-        if not uid in authors:
-            authors[uid] = User.get_user(uid=uid)
-
+    times = pretty_times(Config.wiki.time_format,
+        [ rev["time"] for rev in page["revisions"] ])
+    for rev, pretty in zip(page["revisions"], times):
         history.append(dict(
             id=rev["id"],
-            author=authors[uid],
+            author=authors.get(int(rev["author"])),
             note=rev["note"],
-            pretty_time=pretty_time(Config.wiki.time_format, rev["time"]),
+            pretty_time=pretty,
         ))
 
     g.info["link"] = Wiki.name_to_url(name)
@@ -3,6 +3,7 @@ from __future__ import unicode_literals, print_function, absolute_import
 
 import os
 import datetime
+import pytz
 from yamlsettings import YamlSettings
 
 from rophako.plugin import load_plugin
@@ -12,6 +13,7 @@ basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir
 
 class ConfigHandler(object):
     settings = None
+    tz = None
 
     def load_settings(self):
         """Load the settings and make them available in the global config."""
@@ -31,6 +33,9 @@ class ConfigHandler(object):
             year=datetime.datetime.utcnow().strftime("%Y")
         )
 
+        # Resolve the time zone once, for pretty_time().
+        self.tz = pytz.timezone(self.site.timezone)
+
     def print_settings(self):
         """Pretty-print the contents of the configuration."""
         print(self.settings)
@@ -52,3 +57,13 @@ class ConfigHandler(object):
         return getattr(self.settings, section)
 
 Config = ConfigHandler()
+
+
+def init_worker(settings):
+    """Set up a worker process (see `Photo.get_pool()`) with the settings of
+    the process that started it.
+
+    Spawned workers start out without any settings loaded, and the rophako
+    modules need them just to be imported, so this lives here."""
+    Config.settings = settings
+    Config.tz = pytz.timezone(Config.site.timezone)
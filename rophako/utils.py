@@ -3,26 +3,27 @@
 from __future__ import unicode_literals, print_function, absolute_import
 
 from flask import (g, session, request, render_template, flash, redirect,
-    url_for, current_app)
+    url_for, current_app, Response, stream_with_context, get_flashed_messages,
+    abort)
 from functools import wraps
 import codecs
+import hashlib
 import uuid
 import datetime
 import time
 import pytz
 import re
 import importlib
-import smtplib
 import markdown
 import json
 import sys
+import os
+import tempfile
 try:
     import urlparse
 except ImportError:
     from urllib import parse as urlparse
 import traceback
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 
 from rophako import __version__
 from rophako.log import logger
@@ -68,18 +69,25 @@ def ajax_response(status, msg):
     ))
 
 
+# The parts of the default template variables that never change.
+APP_VARS = None
+
 def default_vars():
     """Default template variables."""
-    return {
-        "time": time.time(),
-        "app": {
+    global APP_VARS
+    if APP_VARS is None:
+        APP_VARS = {
             "name": "Rophako",
             "version": __version__,
             "python_version": "{}.{}".format(sys.version_info.major, sys.version_info.minor),
             "author": "Noah Petherbridge",
             "photo_url": Config.photo.root_public,
             "config": Config,
-        },
+        }
+
+    return {
+        "time": time.time(),
+        "app": APP_VARS,
         "uri": request.path,
         "session": {
             "login": False, # Not logged in, until proven otherwise.
@@ -92,15 +100,170 @@ def default_vars():
     }
 
 
+def cacheable(f):
+    """Mark a view as cacheable for anonymous visitors.
+
+    Pages served by these views are saved in the page cache for visitors who
+    aren't logged in. The view should call `cache_tags()` to name the data
+    the page was built from, so the cached copy is thrown out when that data
+    changes."""
+    f.page_cache = True
+    return f
+
+
+def cache_tags(*tags):
+    """Tag the page currently being rendered with the names of the data it
+    was built from, e.g. `blog` or `post:42`. See `JsonDB.invalidate_tags()`.
+
+    The versions of the tags are taken now, and stored with the page, so
+    call this before loading the data: if it changes while the page is
+    being rendered, the cached copy is already stale."""
+    import rophako.jsondb as JsonDB
+    if not g.get("page_cache_key"):
+        return
+
+    if not "page_cache_tags" in g:
+        g.page_cache_tags = dict()
+    if g.page_cache_tags is None:
+        return # Lost Redis, see below.
+
+    new_tags = [ tag for tag in tags if not tag in g.page_cache_tags ]
+    if len(new_tags) == 0:
+        return
+
+    versions = JsonDB.get_tag_versions(new_tags)
+    if versions is None:
+        # Without the versions, the page can't go in the cache.
+        g.page_cache_tags = None
+        return
+    g.page_cache_tags.update(versions)
+
+
+def page_cache_key():
+    """Get the page cache key for the current request.
+
+    Returns None if this request can't be served from (or saved into) the
+    page cache: only GET requests to cacheable views by anonymous visitors
+    whose sessions hold nothing personal (flashed messages, or the deletion
+    token of a comment they posted) are cached."""
+    if not Config.cache.page_cache or request.method != "GET":
+        return None
+
+    if session.get("login") or "_flashes" in session \
+        or "comment_token" in session:
+        return None
+
+    view = current_app.view_functions.get(request.endpoint)
+    if not getattr(view, "page_cache", False):
+        return None
+
+    # The full URL is used, since pages embed links built from the scheme and
+    # host name (e.g. emoticons).
+    return "page/{}".format(request.url)
+
+
+def fill_page_cache_slots(html, started):
+    """Fill in the per-request values of a page rendered for the page cache.
+
+    Pages that go into the cache are rendered with placeholders for the
+    values that differ between visitors: the CSRF token and the time it took
+    to serve the page."""
+    # The page is on its way out to the browser now; let the CSRF generator
+    # hand out the real token.
+    g.page_cache_key = None
+
+    time_elapsed = "%.03f" % (time.time() - started)
+    return html.replace("%csrf_token%", generate_csrf_token()) \
+               .replace("%time_elapsed%", time_elapsed)
+
+
 def template(name, **kwargs):
     """Render a template to the browser."""
+    return render_template(name, **kwargs)
 
-    html = render_template(name, **kwargs)
 
-    # Get the elapsed time for the request.
-    time_elapsed = "%.03f" % (time.time() - g.info["time"])
-    html = re.sub(r'\%time_elapsed\%', time_elapsed, html)
-    return html
+def stream_template(name, **kwargs):
+    """Render a template to the browser as it's being rendered.
+
+    Use this for long listings, so the top of the page goes out while the
+    rest is still being rendered. Pages going into the page cache are
+    rendered in full like normal."""
+    if g.get("page_cache_key"):
+        return template(name, **kwargs)
+
+    # The session cookie is sent before the template runs, so anything the
+    # template would change in the session has to happen now.
+    generate_csrf_token()
+    get_flashed_messages()
+
+    app = current_app._get_current_object()
+    app.update_template_context(kwargs)
+    stream = app.jinja_env.get_template(name).stream(kwargs)
+    return Response(stream_with_context(stream))
+
+
+def time_elapsed():
+    """Template global: the time spent on the request so far, in seconds.
+
+    Templates can use this directly, or with the `%time_elapsed%` shortcut
+    (see `TimeElapsedExtension` in the app)."""
+    if g.get("page_cache_key"):
+        # Filled in per request by `fill_page_cache_slots()`.
+        return "%time_elapsed%"
+    return "%.03f" % (time.time() - g.request_start)
+
+
+def not_modified(*documents):
+    """Conditional GET support for pages built from DB documents.
+
+    Call this from a view before doing any of the rendering work. The
+    modification times of the `documents` become the page's validators (the
+    ETag and Last-Modified headers are added on the way out). If the
+    browser's copy of the page is still current, this returns a 304 response
+    for the view to return right away; otherwise it returns None."""
+    import rophako.jsondb as JsonDB
+
+    # Flashed messages make the page different from last time.
+    if request.method != "GET" or "_flashes" in session:
+        return None
+
+    mtimes = [ JsonDB.mtime(doc) for doc in documents ]
+    g.validator = mtimes
+    g.validator_documents = list(documents)
+
+    # The ETag wins if the browser sent one. If-Modified-Since can't tell
+    # who the page was for, or when a document was deleted, so it's only
+    # good for anonymous visitors when all the documents exist.
+    if request.if_none_match:
+        if not request.if_none_match.contains_weak(page_etag(mtimes)):
+            return None
+    elif request.if_modified_since and not session.get("login") \
+        and not 0 in mtimes:
+        last_modified = datetime.datetime.utcfromtimestamp(int(max(mtimes)))
+        if request.if_modified_since.replace(tzinfo=None) < last_modified:
+            return None
+    else:
+        return None
+
+    logger.debug("Not modified: {}".format(request.path))
+    return current_app.response_class(status=304)
+
+
+def page_etag(mtimes):
+    """Get the ETag for a page built from documents with these mtimes.
+
+    The session is part of the tag, since pages differ for logged-in users
+    and embed the user's CSRF token."""
+    md5 = hashlib.md5()
+    md5.update(json.dumps([
+        __version__,
+        mtimes,
+        session.get("login"),
+        session.get("uid"),
+        session.get("impersonator"),
+        session.get("_csrf"),
+    ]).encode("utf-8"))
+    return md5.hexdigest()
 
 
 def markdown_template(path):
@@ -237,7 +400,7 @@ def parse_anchors(html):
 
 
 def send_email(to, subject, message, header=None, footer=None, sender=None,
-               reply_to=None):
+               reply_to=None, slots=None):
     """Send a (markdown-formatted) e-mail out.
 
     This will deliver an HTML-formatted e-mail (using the ``email.inc.html``
@@ -245,6 +408,10 @@ def send_email(to, subject, message, header=None, footer=None, sender=None,
     ``footer``. It will also send a plain text version using the raw Markdown
     formatting in case the user can't accept HTML.
 
+    The e-mail is sent in the background (see ``rophako.mail``); to send
+    several different e-mails in one go, build them with ``make_email()`` and
+    pass them all to ``send_emails()``.
+
     Parameters:
         to ([]str): list of addresses to send the message to.
         subject (str): email subject and title.
@@ -255,7 +422,29 @@ def send_email(to, subject, message, header=None, footer=None, sender=None,
         sender (str): optional sender email address. Defaults to the one
             specified in the site configuration.
         reply_to (str): optional Reply-To address header.
+        slots (dict): values that differ between the recipients, as a dict of
+            addresses to dicts of slot names to values. The e-mail is only
+            rendered once, and each ``%name%`` in ``message`` and ``footer``
+            is filled in for each recipient when it's sent.
     """
+    send_emails([ make_email(to, subject, message, header, footer, sender,
+        reply_to, slots) ])
+
+
+def send_emails(messages):
+    """Send a batch of e-mails made by ``make_email()`` in the background."""
+    import rophako.mail as Mail
+    logger.info("Send email to {}".format([ addr for msg in messages
+        for addr in msg["to"] ]))
+    Mail.queue(messages)
+
+
+def make_email(to, subject, message, header=None, footer=None, sender=None,
+               reply_to=None, slots=None):
+    """Render an e-mail for ``send_emails()``. The parameters are the same as
+    for ``send_email()``.
+
+    Returns the message (see ``rophako.mail.queue()``)."""
     if sender is None:
         sender = Config.mail.sender
 
@@ -277,31 +466,15 @@ def send_email(to, subject, message, header=None, footer=None, sender=None,
         footer=footer,
     )
 
-    logger.info("Send email to {}".format(to))
-    if Config.mail.method == "smtp":
-        # Send mail with SMTP.
-        for email in to:
-            msg = MIMEMultipart("alternative")
-            msg.set_charset("utf-8")
-
-            msg["Subject"] = subject
-            msg["From"] = sender
-            msg["To"] = email
-            if reply_to is not None:
-                msg["Reply-To"] = reply_to
-
-            text = MIMEText(message, "plain", "utf-8")
-            msg.attach(text)
-
-            html = MIMEText(html_message, "html", "utf-8")
-            msg.attach(html)
-
-            # Send the e-mail.
-            try:
-                server = smtplib.SMTP(Config.mail.server, Config.mail.port)
-                server.sendmail(sender, [email], msg.as_string())
-            except:
-                pass
+    return dict(
+        to=to,
+        sender=sender,
+        subject=subject,
+        reply_to=reply_to,
+        text=message,
+        html=html_message,
+        slots=slots or {},
+    )
 
 
 def handle_exception(error):
@@ -366,6 +539,9 @@ def handle_exception(error):
 
 def generate_csrf_token():
     """Generator for CSRF tokens."""
+    if g.get("page_cache_key"):
+        # The token is filled in per visitor by `fill_page_cache_slots()`.
+        return "%csrf_token%"
     if "_csrf" not in session:
         session["_csrf"] = str(uuid.uuid4())
     return session["_csrf"]
@@ -392,17 +568,77 @@ def remote_addr():
     return request.remote_addr
 
 
+class UploadSpool(object):
+    """A temp file that an uploaded file is written into while the request is
+    being read (see `rophako.app.RophakoRequest`).
+
+    Writing more than `photo.max_upload_size` bytes to it aborts the request
+    with a 413 error. Unless it's claimed, the file is deleted at the end of
+    the request."""
+
+    def __init__(self):
+        fd, self.name = tempfile.mkstemp(prefix="rophako-upload-",
+            dir=Config.site.tempdir)
+        self.fh = os.fdopen(fd, "w+b")
+        self.size = 0
+        self.limit = int(Config.photo.max_upload_size)
+
+    def write(self, data):
+        self.size += len(data)
+        if self.limit and self.size > self.limit:
+            abort(413)
+        return self.fh.write(data)
+
+    def claim(self, filename):
+        """Move the uploaded file to a new name, and keep it."""
+        self.fh.close()
+        os.rename(self.name, filename)
+        self.name = None
+
+    def discard(self):
+        """Delete the uploaded file, unless it was claimed."""
+        self.fh.close()
+        if self.name and os.path.isfile(self.name):
+            os.unlink(self.name)
+        self.name = None
+
+    def __getattr__(self, name):
+        return getattr(self.fh, name)
+
+
 def server_name():
     """Get the server's hostname."""
     urlparts = list(urlparse.urlparse(request.url_root))
     return urlparts[1]
 
 
+# Memo for pretty_time(), keyed by (format, time stamp). The same few
+# thousand time stamps (of posts, photos and comments) get formatted over and
+# over; once the memo is full it's simply emptied.
+PRETTY_TIME_MEMO = dict()
+PRETTY_TIME_MEMO_SIZE = 4096
+
 def pretty_time(time_format, unix):
     """Pretty-print a time stamp."""
-    tz   = pytz.timezone(Config.site.timezone)
+    key = (time_format, unix)
+    pretty = PRETTY_TIME_MEMO.get(key) # One lookup; other threads may clear it.
+    if pretty is not None:
+        return pretty
+
     date = datetime.datetime.fromtimestamp(unix, pytz.utc)
-    return date.astimezone(tz).strftime(time_format)
+    pretty = date.astimezone(Config.tz).strftime(time_format)
+
+    if len(PRETTY_TIME_MEMO) >= PRETTY_TIME_MEMO_SIZE:
+        PRETTY_TIME_MEMO.clear()
+    PRETTY_TIME_MEMO[key] = pretty
+    return pretty
+
+
+def pretty_times(time_format, timestamps):
+    """Pretty-print a list of time stamps, for listing pages.
+
+    Returns the pretty times in the same order."""
+    return [ pretty_time(time_format, unix) for unix in timestamps ]
 
 
 def sanitize_name(name):
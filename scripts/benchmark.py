@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals, print_function, absolute_import
+
+"""Benchmarks for the slow spots in Rophako.
+
+Every benchmark runs against a throwaway database (and photo folder) filled
+with made-up data, so this is safe to run from a live site's checkout. Redis
+is not used, so the numbers show the cost of the uncached code paths.
+
+The `photos` benchmark runs its cases in child processes, so it only runs on
+Unix-like systems.
+
+Usage: scripts/benchmark.py [benchmark ...]
+
+Run with no arguments to run every benchmark, or name the ones to run."""
+
+import sys
+import os
+import time
+import shutil
+import tempfile
+import random
+import glob
+import logging
+import traceback
+from collections import OrderedDict
+
+sys.path.append(".")
+
+# Loading the app loads the settings.
+from rophako.app import app
+from rophako.settings import Config
+import rophako.jsondb as JsonDB
+from rophako.log import logger
+app.config["TESTING"] = True
+JsonDB.redis_client = None
+JsonDB.disable_redis = True
+logger.setLevel(logging.WARNING)
+
+# Point the app at a scratch area before anything touches the DB.
+SCRATCH = tempfile.mkdtemp(prefix="rophako-bench-")
+Config.db.db_root = os.path.join(SCRATCH, "db")
+Config.photo.root_private = os.path.join(SCRATCH, "photos")
+Config.security.bcrypt_iterations = 4
+Config.cache.page_cache = False
+os.makedirs(Config.photo.root_private)
+
+BENCHMARKS = OrderedDict()
+
+def benchmark(f):
+    """Register a benchmark function."""
+    BENCHMARKS[f.__name__] = f
+    return f
+
+
+def timeit(label, func, rounds=5, clock=time.time):
+    """Time a function, and print the best of a few rounds."""
+    best = None
+    for i in range(rounds):
+        start = clock()
+        func()
+        elapsed = clock() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    print("  {:<40} {:>10.2f} ms".format(label, best * 1000))
+    return best
+
+
+def make_blog(posts=2000, authors=5):
+    """Fill the scratch DB with blog posts spread over the last few years."""
+    import rophako.model.user as User
+    import rophako.model.blog as Blog
+
+    uids = list()
+    for i in range(authors):
+        uids.append(User.create("author{}".format(i), "password"))
+
+    now = int(time.time())
+    for post_id in range(1, posts + 1):
+        JsonDB.commit("blog/entries/{}".format(post_id), dict(
+            fid        = "post-{}".format(post_id),
+            ip         = "127.0.0.1",
+            time       = now - random.randint(0, 60*60*24*365*5),
+            categories = ["Benchmarks"],
+            sticky     = False,
+            comments   = True,
+            emoticons  = True,
+            avatar     = "",
+            privacy    = "public",
+            author     = random.choice(uids),
+            subject    = "Blog post #{}".format(post_id),
+            format     = "markdown",
+            body       = "Hello world!",
+        ), cache=False)
+    Blog.rebuild_index()
+
+
+@benchmark
+def pretty_time():
+    """Formatting time stamps for listing pages."""
+    import pytz
+    import datetime
+    from rophako.utils import pretty_time, pretty_times, PRETTY_TIME_MEMO
+
+    fmt = Config.blog.time_format
+    now = int(time.time())
+    stamps = [ now - random.randint(0, 60*60*24*365*5) for i in range(2000) ]
+
+    def uncached():
+        for unix in stamps:
+            tz = pytz.timezone(Config.site.timezone)
+            date = datetime.datetime.fromtimestamp(unix, pytz.utc)
+            date.astimezone(tz).strftime(fmt)
+
+    def cold():
+        PRETTY_TIME_MEMO.clear()
+        pretty_times(fmt, stamps)
+
+    print("Formatting {} time stamps:".format(len(stamps)))
+    timeit("timezone lookup on every call", uncached)
+    timeit("pretty_times(), empty memo", cold)
+    timeit("pretty_times(), warm memo", lambda: pretty_times(fmt, stamps))
+
+
+@benchmark
+def archive():
+    """Rendering the blog archive page."""
+    if not JsonDB.exists("blog/index"):
+        make_blog()
+
+    from rophako.utils import PRETTY_TIME_MEMO
+    client = app.test_client()
+    def render():
+        PRETTY_TIME_MEMO.clear()
+        resp = client.get("/blog/archive")
+        assert resp.status_code == 200
+        return resp.get_data()
+
+    posts = len(JsonDB.get("blog/index"))
+    print("Blog archive with {} posts:".format(posts))
+    timeit("GET /blog/archive", render)
+
+
+def make_photo_fixtures():
+    """Make a set of big test images, like the ones people upload.
+
+    Returns a list of their file names."""
+    folder = os.path.join(SCRATCH, "fixtures")
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+        in_child(write_photo_fixtures, folder)
+    return sorted(glob.glob(os.path.join(folder, "*.*")))
+
+
+def write_photo_fixtures(folder):
+    """The guts of make_photo_fixtures()."""
+    from PIL import Image
+
+    def noisy(size):
+        # Noise over a gradient compresses about like a real photograph.
+        width, height = size
+        bands = list()
+        for sigma in (40, 60, 80):
+            noise = Image.effect_noise(size, sigma)
+            ramp  = Image.linear_gradient("L").resize(size)
+            bands.append(Image.blend(noise, ramp, 0.5))
+        return Image.merge("RGB", bands)
+
+    fixtures = [
+        ("camera-12mp.jpg",     (4000, 3000), "RGB"),
+        ("camera-24mp.jpg",     (6000, 4000), "RGB"),
+        ("screenshot.png",      (2560, 1600), "RGB"),
+        ("palette.png",         (2000, 2000), "P"),
+        ("animation.gif",       (1600, 1200), "P"),
+    ]
+    for name, size, mode in fixtures:
+        img = noisy(size)
+        if mode == "P":
+            img = img.quantize(64)
+        img.save(os.path.join(folder, name), quality=90)
+
+
+# The benchmark cases that failed in a child process (see in_child()).
+FAILURES = list()
+
+def in_child(func, *args):
+    """Run a function in a child process.
+
+    The image benchmarks run each case this way, so that the memory they use
+    doesn't stay allocated in our process and skew the next case's numbers."""
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            func(*args)
+        except:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    _, status = os.waitpid(pid, 0)
+    if status != 0:
+        FAILURES.append(func.__name__ if not args else "{}: {}".format(
+            func.__name__, args[0]))
+
+
+def peak_memory(func, *args):
+    """Run a function, and get how far our peak memory use grew (in MB)."""
+    import resource
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    func(*args)
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in kilobytes (bytes on Mac OS).
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return float(after - before) / divisor
+
+
+@benchmark
+def photos():
+    """Resizing new photo uploads."""
+    from PIL import Image
+    import rophako.model.photo as Photo
+
+    def full_decode(filename):
+        # How uploads were resized before: decode the whole photo for each
+        # size, and resize with the slowest filter.
+        for size in ["large", "thumb", "avatar"]:
+            img = Image.open(filename)
+            img.load()
+            width, height = img.size
+            if size == "large":
+                new_width = Photo.PHOTO_SCALES[size]
+                img.resize((new_width, int(height * new_width / width)),
+                    Image.LANCZOS)
+            else:
+                length = min(width, height)
+                img.crop((0, 0, length, length)).resize(
+                    (Photo.PHOTO_SCALES[size], Photo.PHOTO_SCALES[size]),
+                    Image.LANCZOS)
+
+    def make_sizes(filename):
+        for name in Photo.photo_files(Photo.make_sizes(filename)):
+            os.unlink(os.path.join(Config.photo.root_private, name))
+
+    def measure(label, func, filename):
+        # Memory first, while this process is still fresh.
+        memory = peak_memory(func, filename)
+        timeit(label, lambda: func(filename), rounds=3)
+        print("  {:<40} {:>10.1f} MB".format("  peak memory", memory))
+
+    for filename in make_photo_fixtures():
+        img = Image.open(filename)
+        print("{} ({}x{} {}, {:.1f} MB):".format(
+            os.path.basename(filename), img.size[0], img.size[1], img.format,
+            os.path.getsize(filename) / 1024.0 / 1024.0,
+        ))
+        in_child(measure, "full decode per size", full_decode, filename)
+        in_child(measure, "make_sizes()", make_sizes, filename)
+
+
+@benchmark
+def rotate():
+    """Rotating a photo (CPU time)."""
+    from PIL import Image
+    import rophako.model.photo as Photo
+
+    clock = time.process_time if hasattr(time, "process_time") else time.clock
+    camera = [ f for f in make_photo_fixtures() if f.endswith(".jpg") ][0]
+
+    def rotate_each(photo):
+        # How photos were rotated before: open, rotate and re-save every size.
+        names = list()
+        for size in ["large", "thumb", "avatar"]:
+            fname = os.path.join(Config.photo.root_private, photo[size])
+            img = Image.open(fname).rotate(90)
+            names.append(Photo.save_photo(img, "jpg"))
+        return names
+
+    def rotate_files(photo):
+        return Photo.photo_files(Photo.rotate_files(photo, "left"))
+
+    def measure(label, func, exif):
+        Config.photo.exif_rotation = exif
+        photo = Photo.make_sizes(camera)
+        def run():
+            for name in func(photo):
+                os.unlink(os.path.join(Config.photo.root_private, name))
+        timeit(label, run, clock=clock)
+
+    print("Rotating a photo uploaded from {}:".format(os.path.basename(camera)))
+    in_child(measure, "rotate each size", rotate_each, False)
+    in_child(measure, "rotate_files()", rotate_files, False)
+    in_child(measure, "rotate_files(), EXIF rotation", rotate_files, True)
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS.keys())
+    for name in names:
+        if not name in BENCHMARKS:
+            print("Unknown benchmark: {}. Choices are: {}".format(
+                name, ", ".join(BENCHMARKS.keys()),
+            ))
+            sys.exit(1)
+
+    try:
+        for name in names:
+            BENCHMARKS[name]()
+            print("")
+    finally:
+        shutil.rmtree(SCRATCH)
+
+    if len(FAILURES):
+        print("These benchmarks failed: {}".format(", ".join(FAILURES)))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
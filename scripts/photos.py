@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals, print_function, absolute_import
+
+"""Maintenance for the photo library.
+
+Commands:
+
+* regenerate: make the sizes of every photo again, after changing the photo
+  size settings (width_large, variant_formats, etc.). With --workers, the
+  photos are resized in parallel in that many processes.
+* orphans: list the files in the photo folder that no photo uses, and
+  delete them with --delete. New files (see photo.file_grace) are skipped.
+* verify: check that every photo's files exist and the album documents
+  agree with each other.
+* backfill-dimensions: record the dimensions and file sizes of the photos
+  that don't have them yet.
+
+Regenerating and backfilling can be stopped and picked up again: the photos
+that are done are remembered in a checkpoint file in site.tempdir until the
+whole run is finished (use --restart to start over).
+
+Redis isn't used unless you pass --redis, so this can run against a local
+copy of the DB. When running it on a live site, pass --redis so it shares
+the site's locks and throws out the site's cached pages that it changes.
+
+Usage: scripts/photos.py [--db <path>] [--redis] <command> [options]"""
+
+import sys
+import os
+import time
+import argparse
+import logging
+
+sys.path.append(".")
+from rophako.settings import Config
+Config.load_settings()
+
+import rophako.jsondb as JsonDB
+import rophako.model.photo as Photo
+from rophako.log import logger
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance for the photo library.")
+    parser.add_argument("--db", help="path to the DB (default: db.db_root)")
+    parser.add_argument("--redis", action="store_true",
+        help="use Redis, when running against a live site")
+    parser.add_argument("--verbose", "-v", action="store_true",
+        help="show the debug logging")
+    commands = parser.add_subparsers(dest="command")
+
+    regenerate = commands.add_parser("regenerate",
+        help="make the sizes of every photo again")
+    regenerate.add_argument("--workers", "-j", type=int,
+        default=int(Config.photo.workers),
+        help="resize this many photos at once")
+    regenerate.add_argument("--restart", action="store_true",
+        help="ignore the checkpoint and start over")
+
+    orphans = commands.add_parser("orphans",
+        help="find photo files that no photo uses")
+    orphans.add_argument("--delete", action="store_true",
+        help="delete the orphaned files")
+
+    commands.add_parser("verify",
+        help="check that every photo's files exist")
+
+    backfill = commands.add_parser("backfill-dimensions",
+        help="record the dimensions of photos that don't have them")
+    backfill.add_argument("--restart", action="store_true",
+        help="ignore the checkpoint and start over")
+
+    args = parser.parse_args()
+    if not args.command:
+        parser.print_help()
+        sys.exit(1)
+
+    if args.db:
+        Config.db.db_root = args.db
+    if not args.redis:
+        JsonDB.redis_client = None
+        JsonDB.disable_redis = True
+    logger.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+
+    if args.command == "regenerate":
+        do_regenerate(args)
+    elif args.command == "orphans":
+        do_orphans(args)
+    elif args.command == "verify":
+        do_verify(args)
+    elif args.command == "backfill-dimensions":
+        do_backfill(args)
+
+
+def all_photos():
+    """Get the keys and data of every photo, in album order."""
+    photos = list()
+    for album in Photo.list_albums():
+        for photo in Photo.list_photos(album["name"]) or []:
+            photos.append([photo["key"], photo["data"]])
+    return photos
+
+
+def do_regenerate(args):
+    """Make the sizes of every photo again."""
+    checkpoint = Checkpoint("regenerate", args.restart)
+    photos = [ [key, data] for key, data in all_photos()
+        if not key in checkpoint and data.get("large")
+        and not data.get("processing") ]
+    progress = Progress(len(photos), len(checkpoint))
+
+    if args.workers > 1:
+        Config.photo.workers = args.workers
+        results = Photo.get_pool().imap_unordered(regenerate_one, photos)
+    else:
+        results = ( regenerate_one(photo) for photo in photos )
+
+    # The files are made by the workers; the DB is only written from here.
+    failed = 0
+    for key, sizes, error in results:
+        if sizes is None:
+            failed += 1
+            progress.step(key, "failed: {}".format(error))
+            continue
+
+        Photo.finish_photo(key, sizes)
+        checkpoint.add(key)
+        progress.step(key, "ok")
+
+    finish(checkpoint, failed)
+
+
+def regenerate_one(photo):
+    """Make the sizes of a photo again (in a worker process).
+
+    Returns the [key, sizes, error] of the photo: the sizes are None if it
+    failed, and the error says why."""
+    key, data = photo
+    try:
+        return [key, Photo.regenerate_sizes(data), None]
+    except Exception as e:
+        return [key, None, str(e)]
+
+
+def do_orphans(args):
+    """Find (and delete) the photo files that no photo uses.
+
+    Files written in the last `photo.file_grace` seconds are left alone, since
+    a photo that's being processed may be about to use them."""
+    # Photos are filed in subfolders by their hash (e.g. ab/cd/abcd(...).jpg),
+    # and older ones directly in the root. Half-written files end in .tmp.
+    photo_root = Config.photo.root_private
+    cutoff = time.time() - int(Config.photo.file_grace)
+    candidates = list()
+    for folder, subfolders, files in os.walk(photo_root):
+        for img in sorted(files):
+            if not "." in img or img.endswith(".tmp"):
+                continue
+            path = os.path.join(folder, img)
+            if os.path.getmtime(path) > cutoff:
+                continue
+            fname = os.path.relpath(path, photo_root)
+            candidates.append(fname.replace(os.sep, "/"))
+
+    # Check them against the photos and the file bookkeeping under the lock,
+    # so that nothing can start using them before they're deleted.
+    with Photo.albums_locked():
+        used = set()
+        for key, data in all_photos():
+            used.update(Photo.photo_files(data))
+
+        hashes = Photo.get_hashes()
+        orphans = list()
+        for fname in candidates:
+            shard = Photo.files_shard(hashes, fname)
+            if fname in used or fname in shard["refs"] \
+                or fname in shard["sources-by-file"] \
+                or fname in shard["released"]:
+                continue
+
+            path = os.path.join(photo_root, fname)
+            if not os.path.isfile(path) or os.path.getmtime(path) > cutoff:
+                continue # Reused just now (see Photo.store_photo()).
+            orphans.append(fname)
+            print("Orphan:", fname)
+
+        if not args.delete:
+            print("Found {} orphaned files.".format(len(orphans)))
+            return
+
+        for fname in orphans:
+            os.unlink(os.path.join(photo_root, fname))
+
+        # And the files that were released by deleted photos, whose grace
+        # period is over.
+        Photo.sweep_released()
+    print("Deleted {} orphaned files.".format(len(orphans)))
+
+
+def do_verify(args):
+    """Check that every photo's files exist and the albums add up."""
+    problems = 0
+    photo_map = Photo.get_map()
+    catalog = Photo.get_catalog()
+
+    for album in catalog["album-order"]:
+        shard = Photo.get_shard(album)
+        if shard is None:
+            print("Album {}: its document is missing!".format(album))
+            problems += 1
+            continue
+
+        settings = catalog["albums"].get(album, {})
+        if not settings.get("cover") in shard["photos"]:
+            print("Album {}: the cover photo {} isn't in it.".format(album, settings.get("cover")))
+            problems += 1
+        if sorted(shard["order"]) != sorted(shard["photos"]):
+            print("Album {}: its order doesn't match its photos.".format(album))
+            problems += 1
+
+        for key, data in shard["photos"].items():
+            if photo_map.get(key) != album:
+                print("Photo {}: the map says it's in album {}, not {}.".format(
+                    key, photo_map.get(key), album))
+                problems += 1
+            if data.get("processing"):
+                print("Photo {}: still marked as processing.".format(key))
+                problems += 1
+            for fname in Photo.photo_files(data):
+                if not os.path.isfile(os.path.join(Config.photo.root_private, fname)):
+                    print("Photo {}: file {} is missing.".format(key, fname))
+                    problems += 1
+
+    for key, album in photo_map.items():
+        if not album in catalog["albums"]:
+            print("Photo {}: the map says it's in album {}, which doesn't exist.".format(key, album))
+            problems += 1
+
+    print("Found {} problems.".format(problems))
+    if problems > 0:
+        sys.exit(1)
+
+
+def do_backfill(args):
+    """Record the dimensions of the photos that don't have them."""
+    checkpoint = Checkpoint("backfill-dimensions", args.restart)
+    photos = [ [key, data] for key, data in all_photos()
+        if not key in checkpoint and data.get("large")
+        and not data.get("processing") and not data.get("dimensions") ]
+    progress = Progress(len(photos), len(checkpoint))
+
+    failed = 0
+    for key, data in photos:
+        try:
+            Photo.edit_photo(key, dict(dimensions=Photo.measure_photo(data)))
+        except Exception as e:
+            failed += 1
+            progress.step(key, "failed: {}".format(e))
+            continue
+        checkpoint.add(key)
+        progress.step(key, "ok")
+
+    finish(checkpoint, failed)
+
+
+def finish(checkpoint, failed):
+    """Wrap up a resumable command."""
+    if failed > 0:
+        print("{} photos failed; run this again to retry them.".format(failed))
+        sys.exit(1)
+    checkpoint.clear()
+    print("Done.")
+
+
+class Checkpoint(object):
+    """The photo keys that a command has finished, kept in a file so the
+    command can pick up where it left off."""
+
+    def __init__(self, command, restart=False):
+        self.path = os.path.join(Config.site.tempdir,
+            "rophako-photos-{}.checkpoint".format(command))
+        if restart:
+            self.clear()
+
+        self.done = set()
+        if os.path.isfile(self.path):
+            with open(self.path, "r") as fh:
+                self.done = set([ line.strip() for line in fh if line.strip() ])
+            print("Resuming: {} photos were done already.".format(len(self.done)))
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def add(self, key):
+        self.done.add(key)
+        with open(self.path, "a") as fh:
+            fh.write(key + "\n")
+
+    def clear(self):
+        if os.path.isfile(self.path):
+            os.unlink(self.path)
+
+
+class Progress(object):
+    """Prints how far along a command is."""
+
+    def __init__(self, total, done=0):
+        self.total = total + done
+        self.count = done
+
+    def step(self, key, status):
+        self.count += 1
+        print("[{}/{}] {}: {}".format(self.count, self.total, key, status))
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
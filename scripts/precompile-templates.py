@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals, print_function, absolute_import
+
+"""Compile all the templates into the template cache.
+
+Run this after deploying in production mode (site.production in your
+settings.yml), so that the web workers find every template already compiled
+instead of compiling them on their first page views.
+
+Usage: scripts/precompile-templates.py"""
+
+import sys
+
+sys.path.append(".")
+from rophako.settings import Config
+Config.load_settings()
+
+from rophako.app import app, TEMPLATE_EXTENSIONS
+
+def main():
+    if Config.site.production != True:
+        print("Production mode isn't enabled; templates aren't being cached.")
+        sys.exit(1)
+
+    compiled, skipped = 0, 0
+    for name in app.jinja_env.list_templates(extensions=TEMPLATE_EXTENSIONS):
+        try:
+            app.jinja_env.get_template(name)
+            compiled += 1
+        except Exception as e:
+            print("Skipped {}: {}".format(name, e))
+            skipped += 1
+
+    print("Compiled {} templates ({} skipped).".format(compiled, skipped))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+from __future__ import unicode_literals, print_function, absolute_import
+
+"""Run background jobs from the Redis job queue.
+
+Turn on jobs.worker in your settings.yml to send background jobs (like
+resizing uploaded photos) to the queue instead of running them in the web
+server processes, and keep this script running (from the root of your
+Rophako checkout, with the same settings as the web app) to work through
+them. You can run more than one of these to get through the jobs faster.
+
+Usage: scripts/worker.py"""
+
+import sys
+
+sys.path.append(".")
+from rophako.settings import Config
+Config.load_settings()
+
+# Loading the app registers all the job functions.
+from rophako.app import app
+import rophako.jobs as Jobs
+
+def main():
+    if Config.jobs.worker != True:
+        print("jobs.worker isn't turned on; the web app runs its own jobs.")
+        sys.exit(1)
+
+    try:
+        Jobs.work()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()